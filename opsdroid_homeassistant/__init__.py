@@ -1,5 +1,17 @@
-from .connector import HassConnector, HassEvent, HassServiceCall
-from .matcher import match_hass_state_changed, match_sunrise, match_sunset
+from .connector import (
+    HassCommandError,
+    HassConnector,
+    HassEvent,
+    HassPresenceChanged,
+    HassServiceCall,
+    HassState,
+)
+from .matcher import (
+    match_hass_state_changed,
+    match_presence_changed,
+    match_sunrise,
+    match_sunset,
+)
 from .skill import HassSkill
 from ._version import get_versions
 
@@ -1,32 +1,179 @@
 import asyncio
+import datetime
+import fnmatch
 import json
 import logging
+import random
+import time
 import urllib.parse
 
 import aiohttp
-from voluptuous import Required
+import arrow
+from voluptuous import All, Any, In, Optional, Range, Required
 
 from opsdroid.connector import Connector, register_event
 from opsdroid.events import Event
 
+from .cache import ResponseCache
+from .codec import CODECS, get_codec
+from .dispatch import OVERFLOW_POLICIES, EventDispatcher
+from .outbound import OutboundQueue
+from .ratelimit import RateLimiter
+from .state import HassState, StateCache, count_presence, get_presence_flags
+from .stream import JSONArrayStream, get_entity_id
+from .sun import get_next_sun_events
+
 _LOGGER = logging.getLogger(__name__)
+CONNECTION_ERRORS = (
+    aiohttp.client_exceptions.ClientConnectorError,
+    aiohttp.client_exceptions.WSServerHandshakeError,
+    aiohttp.client_exceptions.ServerDisconnectedError,
+)
 CONFIG_SCHEMA = {
     Required("token"): str,
     Required("url"): str,
+    Optional("pool_limit"): int,
+    Optional("keepalive_timeout"): Any(int, float),
+    Optional("dns_cache_ttl"): int,
+    Optional("cache_states"): bool,
+    Optional("command_timeout"): Any(int, float),
+    Optional("max_msg_size"): int,
+    Optional("filter_events"): bool,
+    Optional("json_codec"): In(CODECS),
+    Optional("coalesce_messages"): bool,
+    Optional("event_workers"): All(int, Range(min=1)),
+    Optional("event_queue_size"): All(int, Range(min=1)),
+    Optional("event_overflow"): In(OVERFLOW_POLICIES),
+    Optional("debounce"): {str: Any(int, float)},
+    Optional("keep_raw_event"): bool,
+    Optional("cache_attributes"): {str: [str]},
+    Optional("heartbeat_interval"): Any(int, float),
+    Optional("heartbeat_timeout"): Any(int, float),
+    Optional("reconnect_delay"): Any(int, float),
+    Optional("reconnect_max_delay"): Any(int, float),
+    Optional("probe_websocket_urls"): bool,
+    Optional("resync_states"): bool,
+    Optional("local_sun"): bool,
+    Optional("outbound_queue_size"): All(int, Range(min=1)),
+    Optional("outbound_ttl"): Any(int, float),
+    Optional("outbound_drain_timeout"): Any(int, float),
+    Optional("service_batch_window"): Any(int, float),
+    Optional("rate_limit"): {
+        Required("rate"): All(Any(int, float), Range(min=0, min_included=False)),
+        Optional("burst"): All(int, Range(min=1)),
+        Optional("priorities"): {str: int},
+    },
+    Optional("api_cache"): {
+        Optional("ttl"): {str: Any(int, float)},
+        Optional("size"): int,
+    },
 }
 
 
+def get_entity_ids(entity_ids):
+    """Get a list of entity IDs from the ``entity_id`` of a service call."""
+    if isinstance(entity_ids, str):
+        return [entity_id.strip() for entity_id in entity_ids.split(",")]
+    return list(entity_ids)
+
+
+class HassCommandError(Exception):
+    """Raised when Home Assistant reports that a websocket command failed."""
+
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+        super().__init__("{} - {}".format(code, message))
+
+
 class HassEvent(Event):
     """Event class to represent a Home Assistant event."""
 
+    @classmethod
+    def from_state_changed(cls, msg, keep_raw_event=True, resynced=False):
+        """Create an event from a Home Assistant ``state_changed`` event message.
+
+        The entities are computed in a single pass over the message. ``changed`` is only
+        set when the state itself changed, and ``attributes_changed`` is the list of
+        attribute names which were added, removed or given a new value. When an entity
+        is removed from Home Assistant ``state`` is ``None``.
+
+        Args:
+            msg: The decoded websocket event message.
+            keep_raw_event: Store the message as the ``raw_event`` of the event.
+            resynced: Whether the change was found when resyncing states after a
+                      reconnection rather than being sent by Home Assistant.
+
+        """
+        event_data = msg["event"]
+        data = event_data["data"]
+        new_state = data["new_state"]
+        new_attributes = {}
+        if new_state is not None:
+            new_attributes = new_state.get("attributes") or {}
+            new_state = new_state["state"]
+        old_state = data["old_state"]
+        old_attributes = {}
+        if old_state is not None:
+            old_attributes = old_state.get("attributes") or {}
+            old_state = old_state["state"]
+        attributes_changed = [
+            key
+            for key, value in new_attributes.items()
+            if key not in old_attributes or old_attributes[key] != value
+        ]
+        if not old_attributes.keys() <= new_attributes.keys():
+            attributes_changed.extend(old_attributes.keys() - new_attributes.keys())
+
+        event = cls(raw_event=msg if keep_raw_event else None)
+        event.entities = {
+            "event_type": {"value": event_data["event_type"], "confidence": None},
+            "entity_id": {"value": data["entity_id"], "confidence": None},
+            "state": {"value": new_state, "confidence": None},
+            "old_state": {"value": old_state, "confidence": None},
+            "changed": {
+                "value": old_state is None or new_state != old_state,
+                "confidence": None,
+            },
+            "resynced": {"value": resynced, "confidence": None},
+            "attributes_changed": {"value": attributes_changed, "confidence": None},
+        }
+        return event
+
+
+class HassPresenceChanged(Event):
+    """Event class to represent a change in who is home.
+
+    This event is sent when any of the ``anyone_home``, ``everyone_home`` or
+    ``nobody_home`` entities flip as device trackers change state. The ``home``,
+    ``not_home`` and ``other`` entities are the number of device trackers in each.
+
+    """
+
+    @classmethod
+    def from_presence(cls, presence):
+        """Create an event from counts of device trackers in each zone."""
+        event = cls()
+        event.entities = {
+            key: {"value": value, "confidence": None}
+            for key, value in get_presence_flags(presence).items()
+        }
+        for key, value in presence.items():
+            event.entities[key] = {"value": value, "confidence": None}
+        return event
+
 
 class HassServiceCall(Event):
     """Event class to represent making a service call in Home Assistant."""
 
-    def __init__(self, domain, service, data, *args, **kwargs):
+    def __init__(
+        self, domain, service, data, *args, wait=False, timeout=None, **kwargs
+    ):
         self.domain = domain
         self.service = service
         self.data = data
+        self.wait = wait
+        self.timeout = timeout
         super().__init__(*args, **kwargs)
 
 
@@ -40,8 +187,37 @@ class HassConnector(Connector):
         self.name = "homeassistant"
         self.default_target = None
         self.connection = None
+        self.authenticated = False
         self.listening = None
         self.discovery_info = None
+        self.session = None
+        self.inflight_requests = {}
+        self.api_cache = None
+        if "api_cache" in self.config:
+            self.api_cache = ResponseCache(
+                self.config["api_cache"].get("ttl"),
+                size=self.config["api_cache"].get("size", 128),
+            )
+        self.state_cache = (
+            StateCache(self.config.get("cache_attributes"))
+            if self.config.get("cache_states", True)
+            else None
+        )
+        self.dispatcher = EventDispatcher(
+            lambda event: self.opsdroid.parse(event),
+            workers=self.config.get("event_workers", 4),
+            maxsize=self.config.get("event_queue_size", 1000),
+            overflow=self.config.get("event_overflow", "block"),
+        )
+        self.keep_raw_event = self.config.get("keep_raw_event", True)
+        self.debounce = self.config.get("debounce", {})
+        self.debounce_windows = {}
+        self.debounced = {}
+        self.events_coalesced = 0
+        self.presence = None
+        self.sun_times = None
+        self.location = None
+        self.codec = get_codec(self.config.get("json_codec", "json"))
         self.token = self.config.get("token")
         self.api_url = urllib.parse.urljoin(self.config.get("url"), "api/")
 
@@ -51,36 +227,167 @@ class HassConnector(Connector):
             urllib.parse.urljoin(self.api_url, "websocket"),  # Plain Home Assistant
             urllib.parse.urljoin(self.config.get("url"), "websocket"),  # Hassio proxy
         ]
+        self.websocket_url = None
+        self.reconnect_attempts = 0
         self.id = 1
+        self.pending_commands = {}
+        self.service_batches = {}
+        self.rate_limiter = None
+        if "rate_limit" in self.config:
+            self.rate_limiter = RateLimiter(
+                self.config["rate_limit"]["rate"],
+                burst=self.config["rate_limit"].get("burst"),
+                priorities=self.config["rate_limit"].get("priorities"),
+            )
+        self.outbound = OutboundQueue(
+            maxsize=self.config.get("outbound_queue_size", 100),
+            ttl=self.config.get("outbound_ttl", 60),
+        )
+        self.subscriptions = {}
+        self.heartbeat = None
+        self.latency = None
+        self.matched_entities = None
+        self.watched_entities = None
 
     def _get_next_id(self):
         self.id = self.id + 1
         return self.id
 
+    def _get_session(self):
+        """Return the shared HTTP session, creating it if necessary.
+
+        A single session is used for the lifetime of the connector so that
+        connections to Home Assistant are pooled and kept alive between requests
+        instead of paying TCP and TLS setup on every API call.
+
+        """
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.config.get("pool_limit", 100),
+                    keepalive_timeout=self.config.get("keepalive_timeout", 15),
+                    ttl_dns_cache=self.config.get("dns_cache_ttl", 10),
+                )
+            )
+        return self.session
+
+    @property
+    def event_queue_depth(self):
+        """The number of Home Assistant events waiting to be parsed by opsdroid."""
+        return self.dispatcher.depth
+
     async def connect(self):
+        self._get_session()
+        self.dispatcher.start()
         self.discovery_info = await self.query_api("discovery_info")
         self.listening = True
 
     async def listen(self):
-        async with aiohttp.ClientSession() as session:
-            while self.listening:
-                for websocket_url in self.websocket_urls:
-                    try:
-                        async with session.ws_connect(websocket_url) as ws:
-                            self.connection = ws
-                            async for msg in self.connection:
-                                if msg.type == aiohttp.WSMsgType.TEXT:
-                                    await self._handle_message(json.loads(msg.data))
-                                elif msg.type == aiohttp.WSMsgType.ERROR:
-                                    break
-                        _LOGGER.info("Home Assistant closed the websocket, retrying...")
-                    except (
-                        aiohttp.client_exceptions.ClientConnectorError,
-                        aiohttp.client_exceptions.WSServerHandshakeError,
-                        aiohttp.client_exceptions.ServerDisconnectedError,
-                    ):
-                        _LOGGER.info("Unable to connect to Home Assistant, retrying...")
-                    await asyncio.sleep(1)
+        while self.listening:
+            ws = await self._connect_websocket()
+            if ws is not None:
+                try:
+                    async with ws:
+                        self.connection = ws
+                        async for msg in self.connection:
+                            if msg.type in (
+                                aiohttp.WSMsgType.TEXT,
+                                aiohttp.WSMsgType.BINARY,
+                            ):
+                                await self._handle_frame(self.codec.loads(msg.data))
+                            elif msg.type == aiohttp.WSMsgType.ERROR:
+                                break
+                    _LOGGER.info("Home Assistant closed the websocket, retrying...")
+                except CONNECTION_ERRORS:
+                    _LOGGER.info("Lost connection to Home Assistant, retrying...")
+                finally:
+                    self._connection_closed()
+            if self.listening:
+                self.reconnect_attempts += 1
+                await asyncio.sleep(self._get_reconnect_delay())
+
+    def _get_reconnect_delay(self):
+        """Get the time to wait before reconnecting, using exponential backoff with jitter.
+
+        The delay doubles with each failed attempt from ``reconnect_delay`` up to
+        ``reconnect_max_delay`` seconds, and a random jitter of up to half the delay is
+        applied so that many bots restarting at once don't reconnect in lockstep.
+
+        """
+        base = self.config.get("reconnect_delay", 1)
+        delay = min(
+            self.config.get("reconnect_max_delay", 60),
+            base * 2 ** min(self.reconnect_attempts - 1, 32),
+        )
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def _connect_websocket(self):
+        """Open a websocket to Home Assistant.
+
+        The URL which last connected successfully is tried first. With the
+        ``probe_websocket_urls`` option all of the URLs are tried at once and the first
+        to connect is used.
+
+        Returns:
+            The websocket, or ``None`` if none of the URLs could be connected to.
+
+        """
+        urls = sorted(self.websocket_urls, key=lambda url: url != self.websocket_url)
+        if self.config.get("probe_websocket_urls", False):
+            return await self._probe_websocket_urls(urls)
+
+        for url in urls:
+            try:
+                ws = await self._ws_connect(url)
+            except CONNECTION_ERRORS:
+                continue
+            self.websocket_url = url
+            return ws
+        _LOGGER.info("Unable to connect to Home Assistant, retrying...")
+        return None
+
+    async def _probe_websocket_urls(self, urls):
+        """Try all of the websocket URLs at once and use the first to connect.
+
+        Only connection errors are expected from a URL which can't be reached, any other
+        error is raised once the remaining attempts have been cancelled.
+
+        """
+        tasks = {asyncio.ensure_future(self._ws_connect(url)): url for url in urls}
+        ws = None
+        pending = set(tasks)
+        try:
+            while pending and ws is None:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                unexpected = None
+                for task in done:
+                    error = task.exception()
+                    if error is None and ws is None:
+                        ws = task.result()
+                        self.websocket_url = tasks[task]
+                    elif error is None:
+                        await task.result().close()
+                    elif not isinstance(error, CONNECTION_ERRORS):
+                        unexpected = unexpected or error
+                if unexpected is not None:
+                    raise unexpected
+        except BaseException:
+            if ws is not None:
+                await ws.close()
+            raise
+        finally:
+            for task in pending:
+                task.cancel()
+        if ws is None:
+            _LOGGER.info("Unable to connect to Home Assistant, retrying...")
+        return ws
+
+    async def _ws_connect(self, url):
+        return await self._get_session().ws_connect(
+            url, max_msg_size=self.config.get("max_msg_size", 16 * 1024 * 1024)
+        )
 
     async def query_api(self, endpoint, method="GET", decode_json=True, **params):
         """Query a Home Assistant API endpoint.
@@ -96,39 +403,651 @@ class HassConnector(Connector):
                       For GET requests these will be sent as url params.
                       For POST requests these will be dumped as a JSON dict and send at the post body.
 
+        Note:
+            Identical GET requests made while one is already in flight are not sent again,
+            they wait for and share the response of the first request. Callers should not
+            modify the decoded response in place.
+
+            With the ``api_cache`` option, GET responses for the configured endpoints are
+            cached for their TTL. See :meth:`invalidate_api_cache`.
+
         """
         url = urllib.parse.urljoin(self.api_url + "/", endpoint)
-        headers = {
+        if method.upper() != "GET":
+            response = await self._query_api(url, method, decode_json, params)
+            if (
+                endpoint.startswith("states/")
+                and isinstance(response, dict)
+                and self.state_cache is not None
+            ):
+                # Setting a state returns the new state, so the cache doesn't lag behind.
+                self.state_cache.update(endpoint[len("states/") :], response)
+            return response
+
+        key = (endpoint, tuple(sorted(params.items())), decode_json)
+        ttl = self.api_cache.get_ttl(endpoint) if self.api_cache is not None else None
+        if ttl:
+            response = self.api_cache.get(key)
+            if response is not None:
+                return response
+
+        request = self.inflight_requests.get(key)
+        if request is None:
+            request = asyncio.ensure_future(
+                self._query_api(url, method, decode_json, params)
+            )
+            self.inflight_requests[key] = request
+            request.add_done_callback(lambda _: self.inflight_requests.pop(key, None))
+        # Shield the shared request so one caller being cancelled doesn't cancel it
+        # for everyone else.
+        response = await asyncio.shield(request)
+        if ttl and response is not None:
+            self.api_cache.set(key, response, ttl)
+        return response
+
+    def invalidate_api_cache(self, endpoint=None):
+        """Remove cached API responses.
+
+        Args:
+            endpoint: The endpoint to remove responses for. Removes all if not set.
+
+        """
+        if self.api_cache is not None:
+            self.api_cache.invalidate(endpoint)
+
+    def _get_headers(self):
+        return {
             "Authorization": "Bearer " + self.token,
             "Content-Type": "application/json",
         }
+
+    async def iter_states(self, prefix=None):
+        """Stream the states of all entities from the API.
+
+        The response is parsed incrementally as it arrives and states are yielded one
+        at a time, so the full list of states is never held in memory.
+
+        Args:
+            prefix: Only yield entities whose ID starts with this, e.g ``light.``. The
+                    entity ID is checked before the rest of the state is decoded.
+
+        Yields:
+            State dictionaries.
+
+        """
+        url = urllib.parse.urljoin(self.api_url + "/", "states")
+        async with self._get_session().get(url, headers=self._get_headers()) as resp:
+            if resp.status >= 400:
+                _LOGGER.error("Error %s - %s", resp.status, await resp.text())
+                return
+            stream = JSONArrayStream()
+            async for chunk in resp.content.iter_any():
+                for element in stream.feed(chunk):
+                    if prefix is not None:
+                        entity_id = get_entity_id(element)
+                        if entity_id is None or not entity_id.startswith(prefix):
+                            continue
+                    yield self.codec.loads(element)
+
+    async def _query_api(self, url, method, decode_json, params):
+        headers = self._get_headers()
         response = None
         _LOGGER.debug("Making a %s request to %s", method, url)
-        async with aiohttp.ClientSession() as session:
-            if method.upper() == "GET":
-                async with session.get(url, headers=headers, params=params) as resp:
-                    if resp.status >= 400:
-                        _LOGGER.error("Error %s - %s", resp.status, await resp.text())
-                    else:
-                        response = await resp.text()
-            if method.upper() == "POST":
-                async with session.post(
-                    url, headers=headers, data=json.dumps(params)
-                ) as resp:
-                    if resp.status >= 400:
-                        _LOGGER.error("Error %s - %s", resp.status, await resp.text())
-                    else:
-                        response = await resp.text()
+        session = self._get_session()
+        if method.upper() == "GET":
+            async with session.get(url, headers=headers, params=params) as resp:
+                if resp.status >= 400:
+                    _LOGGER.error("Error %s - %s", resp.status, await resp.text())
+                else:
+                    response = await resp.read() if decode_json else await resp.text()
+        if method.upper() == "POST":
+            async with session.post(
+                url, headers=headers, data=self.codec.dumps(params)
+            ) as resp:
+                if resp.status >= 400:
+                    _LOGGER.error("Error %s - %s", resp.status, await resp.text())
+                else:
+                    response = await resp.read() if decode_json else await resp.text()
         if decode_json and response:
-            response = json.loads(response)
+            response = self.codec.loads(response)
         return response
 
+    async def get_state(self, entity_id, fresh=False):
+        """Get the full state object of an entity.
+
+        States are read from the in-memory state cache when it is in sync with
+        Home Assistant, otherwise the API is queried. Entities which this connector has
+        just sent a service call for are also read from the API until their state change
+        arrives, so a read straight after a write doesn't return the old state.
+
+        Args:
+            entity_id: The ID of the entity to get the state for.
+            fresh: Skip the state cache and always query the API.
+
+        Returns:
+            The state of the entity, or ``None`` if it does not exist. Cached states are
+            :class:`HassState` records which can be read like the state dictionaries
+            returned by the API.
+
+        """
+        if (
+            not fresh
+            and self.state_cache is not None
+            and self.state_cache.synced
+            and self.state_cache.covers(entity_id)
+            and not self.state_cache.is_stale(entity_id)
+        ):
+            return self.state_cache.get(entity_id)
+        return await self.query_api("states/" + entity_id)
+
+    async def get_states(self, fresh=False, domain=None):
+        """Get the full state objects of all entities.
+
+        Args:
+            fresh: Skip the state cache and always query Home Assistant.
+            domain: Only get entities in this domain, e.g ``light``.
+
+        Returns:
+            A list of states, see :meth:`get_state`.
+
+        """
+        if (
+            not fresh
+            and self.state_cache is not None
+            and self.state_cache.synced
+            and self.state_cache.complete
+        ):
+            if domain is None:
+                return self.state_cache.all()
+            return self.state_cache.domain(domain)
+        if domain is not None:
+            # Filter the states as they are streamed rather than fetching them all.
+            return [state async for state in self.iter_states(domain + ".")]
+        if self.authenticated:
+            return await self.send_command({"type": "get_states"}, wait=True)
+        return await self.query_api("states")
+
+    async def get_presence(self, fresh=False):
+        """Count the device trackers which are home, not home or in another zone.
+
+        The counts are kept up to date by the state cache, so this only queries Home
+        Assistant when the cache can't be used.
+
+        Args:
+            fresh: Skip the state cache and always query Home Assistant.
+
+        Returns:
+            A dictionary of counts with the keys ``home``, ``not_home`` and ``other``.
+
+        """
+        if (
+            not fresh
+            and self.state_cache is not None
+            and self.state_cache.synced
+            and self.state_cache.complete
+        ):
+            return dict(self.state_cache.presence)
+        return count_presence(
+            await self.get_states(fresh=fresh, domain="device_tracker")
+        )
+
+    async def get_sun_times(self, fresh=False):
+        """Get the times of the next sunrise and sunset.
+
+        The times are parsed from the ``sun.sun`` entity and cached until it changes or
+        one of the times passes. With the ``local_sun`` option they are instead
+        calculated from the Home Assistant location, so once the location is known they
+        are available even when Home Assistant is not.
+
+        Args:
+            fresh: Skip the cache and always get the times from Home Assistant.
+
+        Returns:
+            A dictionary with the ``next_rising`` and ``next_setting`` datetimes. When
+            calculated locally near the poles either can be ``None`` if the sun doesn't
+            rise or set within the next year.
+
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if (
+            not fresh
+            and self.sun_times is not None
+            and all(
+                sun_time is None or sun_time > now
+                for sun_time in self.sun_times.values()
+            )
+        ):
+            return self.sun_times
+
+        if self.config.get("local_sun", False):
+            if self.location is None or fresh:
+                config = await self.get_config()
+                self.location = (
+                    config["latitude"],
+                    config["longitude"],
+                    config.get("elevation", 0),
+                )
+            self.sun_times = get_next_sun_events(*self.location, now=now)
+            return self.sun_times
+
+        sun = await self.get_state("sun.sun", fresh=fresh)
+        sun_times = {
+            key: arrow.get(sun["attributes"][key]).datetime
+            for key in ("next_rising", "next_setting")
+        }
+        # Only keep the times if we will see the sun change and can forget them.
+        if self.authenticated and (
+            self.watched_entities is None or "sun.sun" in self.watched_entities
+        ):
+            self.sun_times = sun_times
+        return sun_times
+
+    async def get_config(self):
+        """Get the Home Assistant core configuration.
+
+        Returns:
+            A dictionary of the configuration, including the location and unit system.
+
+        """
+        if self.authenticated:
+            return await self.send_command({"type": "get_config"}, wait=True)
+        return await self.query_api("config")
+
+    async def get_services(self):
+        """Get the services available in Home Assistant.
+
+        Returns:
+            A dictionary of service descriptions keyed by domain and then service name.
+
+        """
+        if self.authenticated:
+            return await self.send_command({"type": "get_services"}, wait=True)
+        services = await self.query_api("services")
+        if services is None:
+            return None
+        return {domain["domain"]: domain["services"] for domain in services}
+
+    async def render_template(self, template):
+        """Ask Home Assistant to render a template.
+
+        Args:
+            template: The template string to be rendered by Home Assistant.
+
+        Returns:
+            The rendered template as a string.
+
+        Raises:
+            HassCommandError: If Home Assistant couldn't render the template over the
+                              websocket.
+
+        """
+        if not self.authenticated:
+            return await self.query_api(
+                "template", method="POST", decode_json=False, template=template
+            )
+
+        # Rendering over the websocket is a subscription which sends the rendered
+        # template as an event, so we take the first render and then unsubscribe.
+        # The result is sent as a native type, e.g 2 rather than "2", so it is converted
+        # to a string to match the REST API.
+        rendered = asyncio.get_event_loop().create_future()
+
+        async def on_render(msg):
+            if rendered.done():
+                return
+            event = msg.get("event") or {}
+            if "result" in event:
+                rendered.set_result(str(event["result"]))
+            else:
+                rendered.set_exception(
+                    HassCommandError("template_error", event.get("error", event))
+                )
+
+        subscription = await self.subscribe(
+            {"type": "render_template", "template": template}, on_render
+        )
+        try:
+            return await asyncio.wait_for(
+                rendered, self.config.get("command_timeout", 10)
+            )
+        finally:
+            await self.unsubscribe(subscription)
+
+    async def _sync_states(self):
+        """Hydrate the state cache with a full snapshot of states from Home Assistant.
+
+        This runs in the websocket reader, so if the snapshot can't be fetched the error
+        is logged and the cache is left unsynced, which means reads fall back to the API.
+
+        """
+        if self.state_cache is None:
+            return
+        try:
+            states = await self.query_api("states")
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+            _LOGGER.warning("Unable to load states from Home Assistant: %r", error)
+            return
+        if states is None:
+            return
+
+        # If we have states from a previous connection then some changes may have been
+        # missed while we were disconnected, so we send events for them now.
+        missed = []
+        if self.state_cache.states and self.config.get("resync_states", True):
+            missed = self.state_cache.diff(states)
+        self.state_cache.load(states, tracked=self.watched_entities)
+        await self._check_presence()
+        if missed:
+            _LOGGER.info(
+                "Resyncing %d states changed while disconnected from Home Assistant.",
+                len(missed),
+            )
+        for old_state, new_state in missed:
+            await self._dispatch_state_changed(
+                {
+                    "type": "event",
+                    "event": {
+                        "event_type": "state_changed",
+                        "data": {
+                            "entity_id": (new_state or old_state)["entity_id"],
+                            "old_state": self.state_cache.resynced_old_state(
+                                old_state, new_state
+                            ),
+                            "new_state": new_state,
+                        },
+                    },
+                },
+                resynced=True,
+            )
+
+    def _find_matched_entities(self):
+        """Find the entities which the loaded skills match state changes for.
+
+        Returns:
+            A set of entity IDs, or ``None`` if any skill may want events for every entity.
+
+        """
+        if self.opsdroid is None:
+            return None
+        entity_ids = set()
+        for skill in self.opsdroid.skills:
+            for matcher in getattr(skill, "matchers", []):
+                if "always" in matcher:
+                    return None
+                if "catchall" in matcher and not matcher.get("messages_only"):
+                    return None
+                event_type = matcher.get("event_type", {}).get("type")
+                if event_type in (HassPresenceChanged, "HassPresenceChanged"):
+                    # Presence is counted from every device tracker.
+                    return None
+                if event_type not in (HassEvent, "HassEvent"):
+                    continue
+                entity_id = matcher["event_type"].get("entity_id")
+                if not isinstance(entity_id, str):
+                    return None
+                entity_ids.add(entity_id)
+        return entity_ids
+
+    async def _subscribe_state_changes(self):
+        """Subscribe to state changes for the entities the skills are interested in.
+
+        By default every ``state_changed`` event is subscribed to. With the ``filter_events``
+        option the connector instead asks Home Assistant to only send changes for entities
+        which are matched by a skill, using a state trigger subscription. If any skill
+        matches all Home Assistant events the full event stream is used, as it is if Home
+        Assistant rejects the trigger subscription.
+
+        """
+        self.matched_entities = self._find_matched_entities()
+        self.watched_entities = None
+        if self.config.get("filter_events", False):
+            self.watched_entities = self.matched_entities
+
+        # We can't wait for results here as they are read by this same loop.
+        if self.watched_entities is None:
+            await self._subscribe_all_state_changes()
+        elif self.watched_entities:
+            asyncio.ensure_future(self._subscribe_state_trigger())
+
+    async def _subscribe_all_state_changes(self):
+        await self.subscribe(
+            {"type": "subscribe_events", "event_type": "state_changed"},
+            self._handle_state_changed,
+            wait=False,
+        )
+
+    async def _subscribe_state_trigger(self):
+        """Subscribe to state changes of the watched entities with a state trigger.
+
+        If Home Assistant rejects the subscription, e.g because it is too old or the token
+        isn't allowed to use it, all state changes are subscribed to instead and the state
+        cache is reloaded with every entity.
+
+        """
+        _LOGGER.debug(
+            "Subscribing to state changes for %s", ", ".join(self.watched_entities)
+        )
+        try:
+            await self.subscribe(
+                {
+                    "type": "subscribe_trigger",
+                    "trigger": {
+                        "platform": "state",
+                        "entity_id": sorted(self.watched_entities),
+                    },
+                },
+                self._handle_state_trigger,
+            )
+            return
+        except ConnectionError:
+            return
+        except (HassCommandError, asyncio.TimeoutError) as error:
+            _LOGGER.warning(
+                "Unable to filter Home Assistant events, "
+                "subscribing to all state changes instead: %s",
+                error,
+            )
+        self.watched_entities = None
+        await self._subscribe_all_state_changes()
+        await self._sync_states()
+
+    async def subscribe(self, command, callback, wait=True, timeout=None):
+        """Send a command which subscribes to events from Home Assistant.
+
+        Events sent by Home Assistant for the subscription are passed to ``callback``.
+
+        Args:
+            command: The subscription command dictionary, without an ``id``.
+            callback: A coroutine function called with each event message.
+            wait: Wait for Home Assistant to confirm the subscription.
+            timeout: Seconds to wait for the confirmation.
+
+        Returns:
+            The subscription ID which can be passed to :meth:`unsubscribe`.
+
+        """
+        msg_id = self._get_next_id()
+        self.subscriptions[msg_id] = callback
+        try:
+            await self._send_command(msg_id, command, wait, timeout)
+        except Exception:
+            self.subscriptions.pop(msg_id, None)
+            raise
+        return msg_id
+
+    async def unsubscribe(self, subscription):
+        """Cancel a subscription created with :meth:`subscribe`."""
+        self.subscriptions.pop(subscription, None)
+        if self.authenticated:
+            await self.send_command(
+                {"type": "unsubscribe_events", "subscription": subscription}
+            )
+
+    async def send_command(self, command, wait=False, timeout=None):
+        """Send a command to Home Assistant over the websocket.
+
+        Each command is given the next message ID. When ``wait`` is set the command is
+        recorded in :attr:`pending_commands` until Home Assistant sends a matching
+        ``result`` message, so many commands can be in flight on the one socket while
+        still being able to tell which of them failed.
+
+        Args:
+            command: The command dictionary, without an ``id``.
+            wait: Wait for the result of the command.
+            timeout: Seconds to wait for the result. Defaults to the ``command_timeout``
+                     config option.
+
+        Returns:
+            The ``result`` field of the response if ``wait`` is set, else ``None``.
+
+        Raises:
+            HassCommandError: If Home Assistant reports the command failed.
+            asyncio.TimeoutError: If no result arrives within the timeout.
+
+        """
+        return await self._send_command(self._get_next_id(), command, wait, timeout)
+
+    async def _send_command(self, msg_id, command, wait, timeout):
+        command = dict(command, id=msg_id)
+        if not wait:
+            await self.connection.send_json(command, dumps=self.codec.dumps)
+            return None
+
+        future = asyncio.get_event_loop().create_future()
+        self.pending_commands[msg_id] = future
+        try:
+            await self.connection.send_json(command, dumps=self.codec.dumps)
+        except Exception:
+            self.pending_commands.pop(msg_id, None)
+            raise
+        return await self._wait_for_result(msg_id, future, timeout)
+
+    async def _wait_for_result(self, msg_id, future, timeout):
+        if timeout is None:
+            timeout = self.config.get("command_timeout", 10)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending_commands.pop(msg_id, None)
+
+    async def _flush_outbound(self):
+        """Send the commands which were queued while disconnected, in order."""
+        while self.outbound:
+            item = self.outbound.pop()
+            if item is None:
+                break
+            command, sent = item
+            msg_id = self._get_next_id()
+            future = None
+            if sent is not None:
+                future = asyncio.get_event_loop().create_future()
+                self.pending_commands[msg_id] = future
+            await self.connection.send_json(
+                dict(command, id=msg_id), dumps=self.codec.dumps
+            )
+            self.outbound.flushed += 1
+            if sent is not None and not sent.done():
+                sent.set_result((msg_id, future))
+
+    async def _heartbeat(self):
+        """Periodically ping Home Assistant and reconnect if it stops responding.
+
+        A half-open TCP connection can leave the websocket silently dead, so if a pong is
+        not received within ``heartbeat_timeout`` seconds the websocket is closed which
+        causes :meth:`listen` to reconnect. The round trip time of the last ping is stored
+        in :attr:`latency`.
+
+        With the ``block`` overflow policy a full event queue stops the connector reading
+        from the websocket, so the pong can't be read even though the connection is fine.
+        A ping which times out while events were waiting for space is not treated as a
+        dead connection.
+
+        """
+        interval = self.config.get("heartbeat_interval", 30)
+        timeout = self.config.get("heartbeat_timeout", 10)
+        while True:
+            await asyncio.sleep(interval)
+            start = time.monotonic()
+            blocked = self.dispatcher.blocked
+            try:
+                await self.send_command({"type": "ping"}, wait=True, timeout=timeout)
+            except asyncio.TimeoutError:
+                if self.dispatcher.blocking or self.dispatcher.blocked != blocked:
+                    _LOGGER.warning(
+                        "Home Assistant events are waiting for skills to finish, "
+                        "the ping response could not be read."
+                    )
+                    continue
+                _LOGGER.warning(
+                    "Home Assistant did not respond to a ping, reconnecting..."
+                )
+                self.latency = None
+                await self.connection.close()
+                return
+            except ConnectionError:
+                return
+            self.latency = time.monotonic() - start
+            _LOGGER.debug("Home Assistant ping took %.3fs", self.latency)
+
+    def _connection_closed(self):
+        """Reset all per-connection state after the websocket closes."""
+        self.authenticated = False
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+            self.heartbeat = None
+        self.subscriptions = {}
+        if self.state_cache is not None:
+            self.state_cache.invalidate()
+        if not self.config.get("local_sun", False):
+            self.sun_times = None
+        for future in self.pending_commands.values():
+            if not future.done():
+                future.set_exception(
+                    ConnectionError("Home Assistant closed the websocket.")
+                )
+        self.pending_commands = {}
+
+    async def _enable_coalescing(self, ha_version):
+        """Ask Home Assistant to batch several messages into a single frame.
+
+        The ``supported_features`` command was added in Home Assistant 2022.3 and older
+        versions log an error for unknown commands, so it is only sent to newer versions.
+        If it fails anyway messages are sent one per frame as before.
+
+        """
+        try:
+            year, month = (int(part) for part in ha_version.split(".")[:2])
+        except (AttributeError, ValueError):
+            return
+        if (year, month) < (2022, 3):
+            return
+        try:
+            await self.send_command(
+                {"type": "supported_features", "features": {"coalesce_messages": 1}},
+                wait=True,
+            )
+        except (HassCommandError, asyncio.TimeoutError, ConnectionError) as error:
+            _LOGGER.debug("Unable to enable message coalescing: %s", error)
+
+    async def _handle_frame(self, data):
+        """Handle a decoded websocket frame.
+
+        When message coalescing is enabled Home Assistant may batch several messages into
+        a single frame as a JSON array.
+
+        """
+        if isinstance(data, list):
+            for msg in data:
+                await self._handle_message(msg)
+        else:
+            await self._handle_message(data)
+
     async def _handle_message(self, msg):
         msg_type = msg.get("type")
 
         if msg_type == "auth_required":
             await self.connection.send_json(
-                {"type": "auth", "access_token": self.token}
+                {"type": "auth", "access_token": self.token}, dumps=self.codec.dumps
             )
 
         if msg_type == "auth_invalid":
@@ -137,53 +1056,304 @@ class HassConnector(Connector):
 
         if msg_type == "auth_ok":
             _LOGGER.info("Authenticated with Home Assistant.")
-            await self.connection.send_json(
-                {
-                    "id": self._get_next_id(),
-                    "type": "subscribe_events",
-                    "event_type": "state_changed",
-                }
-            )
+            self.authenticated = True
+            self.reconnect_attempts = 0
+            if self.config.get("coalesce_messages", True):
+                asyncio.ensure_future(self._enable_coalescing(msg.get("ha_version")))
+            await self._subscribe_state_changes()
+            await self._sync_states()
+            await self._flush_outbound()
+            if self.config.get("heartbeat_interval", 30):
+                self.heartbeat = asyncio.ensure_future(self._heartbeat())
 
         if msg_type == "event":
-            try:
-                new_state = msg["event"]["data"]["new_state"]
-                old_state = msg["event"]["data"]["old_state"]
-                event = HassEvent(raw_event=msg)
-                event.update_entity("event_type", msg["event"]["event_type"])
-                event.update_entity("entity_id", msg["event"]["data"]["entity_id"])
-                event.update_entity("state", new_state["state"])
-                event.update_entity(
-                    "old_state", old_state["state"] if old_state is not None else None
-                )
-                changed = old_state is None or new_state["state"] != old_state["state"]
-                event.update_entity("changed", changed)
-                await self.opsdroid.parse(event)
-            except (TypeError, KeyError):
-                _LOGGER.error(
-                    "Home Assistant sent an event which didn't look like one we expected."
+            callback = self.subscriptions.get(msg.get("id"))
+            if callback is None:
+                # Events can still arrive for a subscription we have just cancelled.
+                _LOGGER.debug(
+                    "Ignoring an event for unknown subscription %s.", msg.get("id")
                 )
-                _LOGGER.error(msg)
+            else:
+                try:
+                    await callback(msg)
+                except Exception:  # pylint: disable=broad-except
+                    _LOGGER.exception("Error handling a Home Assistant event.")
+
+        if msg_type == "pong":
+            future = self.pending_commands.pop(msg.get("id"), None)
+            if future is not None and not future.done():
+                future.set_result(None)
 
         if msg_type == "result":
+            future = self.pending_commands.pop(msg.get("id"), None)
+            if future is not None and future.done():
+                future = None
             if msg["success"]:
-                pass
+                if future is not None:
+                    future.set_result(msg.get("result"))
+            elif future is not None:
+                future.set_exception(
+                    HassCommandError(msg["error"]["code"], msg["error"]["message"])
+                )
             else:
                 _LOGGER.error("%s - %s", msg["error"]["code"], msg["error"]["message"])
 
+    async def _handle_state_trigger(self, msg):
+        """Convert a state trigger event into a ``state_changed`` event and handle it."""
+        try:
+            trigger = msg["event"]["variables"]["trigger"]
+            data = {
+                "entity_id": trigger["entity_id"],
+                "old_state": trigger["from_state"],
+                "new_state": trigger["to_state"],
+            }
+        except (TypeError, KeyError):
+            _LOGGER.error(
+                "Home Assistant sent a trigger which didn't look like one we expected."
+            )
+            _LOGGER.error(msg)
+            return
+        await self._handle_state_changed(
+            {
+                "id": msg.get("id"),
+                "type": "event",
+                "event": {"event_type": "state_changed", "data": data},
+            }
+        )
+
+    async def _handle_state_changed(self, msg):
+        try:
+            entity_id = msg["event"]["data"]["entity_id"]
+            new_state = msg["event"]["data"]["new_state"]
+        except (TypeError, KeyError):
+            _LOGGER.error(
+                "Home Assistant sent an event which didn't look like one we expected."
+            )
+            _LOGGER.error(msg)
+            return
+        if self.state_cache is not None:
+            self.state_cache.update(entity_id, new_state)
+        if entity_id == "sun.sun" and not self.config.get("local_sun", False):
+            self.sun_times = None
+
+        window = self._get_debounce_window(entity_id)
+        if window:
+            self._debounce_state_changed(entity_id, msg, window)
+        else:
+            await self._dispatch_state_changed(msg)
+        if entity_id.startswith("device_tracker."):
+            await self._check_presence()
+
+    async def _check_presence(self):
+        """Send a :class:`HassPresenceChanged` event if anyone, everyone or nobody home flips.
+
+        The first check after starting only records the current presence.
+
+        """
+        if (
+            self.state_cache is None
+            or not self.state_cache.synced
+            or not self.state_cache.complete
+        ):
+            return
+        presence = get_presence_flags(self.state_cache.presence)
+        if self.presence is not None and presence != self.presence:
+            await self.dispatcher.put(
+                HassPresenceChanged.from_presence(self.state_cache.presence),
+                key="device_tracker",
+            )
+        self.presence = presence
+
+    def _get_debounce_window(self, entity_id):
+        """Get the debounce window in seconds for an entity from the ``debounce`` option.
+
+        Keys of the option can be entity IDs or glob patterns such as ``sensor.*_power``.
+
+        """
+        if entity_id not in self.debounce_windows:
+            window = self.debounce.get(entity_id)
+            if window is None:
+                for pattern, pattern_window in self.debounce.items():
+                    if fnmatch.fnmatchcase(entity_id, pattern):
+                        window = pattern_window
+                        break
+            self.debounce_windows[entity_id] = window
+        return self.debounce_windows[entity_id]
+
+    def _debounce_state_changed(self, entity_id, msg, window):
+        """Hold back a state change until the entity's debounce window has passed.
+
+        Only the latest new state within the window is dispatched, but the old state from
+        the first change in the window is kept so that ``changed`` is still correct.
+
+        """
+        if entity_id in self.debounced:
+            pending, _ = self.debounced[entity_id]
+            pending["event"]["data"]["new_state"] = msg["event"]["data"]["new_state"]
+            self.events_coalesced += 1
+            return
+
+        pending = dict(msg, event=dict(msg["event"], data=dict(msg["event"]["data"])))
+        handle = asyncio.get_event_loop().call_later(
+            window,
+            lambda: asyncio.ensure_future(self._flush_debounced(entity_id)),
+        )
+        self.debounced[entity_id] = (pending, handle)
+
+    async def _flush_debounced(self, entity_id):
+        pending, _ = self.debounced.pop(entity_id)
+        await self._dispatch_state_changed(pending)
+
+    async def _dispatch_state_changed(self, msg, resynced=False):
+        entity_id = msg["event"]["data"]["entity_id"]
+        if self.matched_entities is not None and entity_id not in self.matched_entities:
+            # No skill will ever match this event so don't bother building it.
+            return
+        try:
+            event = HassEvent.from_state_changed(msg, self.keep_raw_event, resynced)
+        except (TypeError, KeyError):
+            _LOGGER.error(
+                "Home Assistant sent an event which didn't look like one we expected."
+            )
+            _LOGGER.error(msg)
+            return
+        await self.dispatcher.put(event, key=entity_id)
+
     @register_event(HassServiceCall)
     async def send_service_call(self, event):
-        await self.connection.send_json(
-            {
-                "id": self._get_next_id(),
-                "type": "call_service",
-                "domain": event.domain,
-                "service": event.service,
-                "service_data": event.data,
+        command = {
+            "type": "call_service",
+            "domain": event.domain,
+            "service": event.service,
+            "service_data": event.data,
+        }
+        if self.state_cache is not None and "entity_id" in event.data:
+            self.state_cache.mark_stale(
+                get_entity_ids(event.data["entity_id"]),
+                self.config.get("command_timeout", 10),
+            )
+        window = self.config.get("service_batch_window", 0)
+        if window and "entity_id" in event.data:
+            return await self._batch_service_call(command, event, window)
+        return await self._send_service_command(command, event.wait, event.timeout)
+
+    async def _batch_service_call(self, command, event, window):
+        """Merge service calls which only differ by their entities into one call.
+
+        Calls to the same service with the same data made within ``window`` seconds of
+        each other are sent as a single call with a list of all of their entity IDs.
+
+        A call for an entity which is already in a waiting batch, for any service, sends
+        that batch first. This keeps calls for each entity in order and means calls such
+        as two toggles of the same light are never merged into one.
+
+        """
+        data = dict(event.data)
+        entity_ids = get_entity_ids(data.pop("entity_id"))
+        key = (
+            event.domain,
+            event.service,
+            json.dumps(data, sort_keys=True, default=str),
+        )
+
+        for other_key, other_batch in list(self.service_batches.items()):
+            if any(entity_id in other_batch["entity_ids"] for entity_id in entity_ids):
+                await self._flush_service_batch(other_key)
+
+        batch = self.service_batches.get(key)
+        if batch is None:
+            batch = {
+                "command": dict(command, service_data=data),
+                "entity_ids": [],
+                "waiters": [],
+                "timeout": event.timeout,
+                "handle": asyncio.get_event_loop().call_later(
+                    window,
+                    lambda: asyncio.ensure_future(self._flush_service_batch(key)),
+                ),
             }
+            self.service_batches[key] = batch
+        batch["entity_ids"].extend(entity_ids)
+
+        if not event.wait:
+            return None
+        future = asyncio.get_event_loop().create_future()
+        batch["waiters"].append(future)
+        return await future
+
+    async def _flush_service_batch(self, key):
+        batch = self.service_batches.pop(key, None)
+        if batch is None:
+            return
+        batch["handle"].cancel()
+        command = batch["command"]
+        entity_ids = batch["entity_ids"]
+        command["service_data"]["entity_id"] = (
+            entity_ids[0] if len(entity_ids) == 1 else entity_ids
         )
+        waiters = batch["waiters"]
+        try:
+            result = await self._send_service_command(
+                command, bool(waiters), batch["timeout"]
+            )
+        except Exception as error:  # pylint: disable=broad-except
+            if not waiters:
+                _LOGGER.error("Unable to send batched service call - %s", error)
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(error)
+        else:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(result)
+
+    async def _send_service_command(self, command, wait, timeout):
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire(self._get_service_priority(command))
+
+        if self.authenticated and not self.outbound:
+            return await self.send_command(command, wait=wait, timeout=timeout)
+
+        # While disconnected, or until earlier queued calls have been sent, the call is
+        # queued and sent once the connector has authenticated again.
+        sent = self.outbound.put(command, wait=wait)
+        if sent is None:
+            return None
+        msg_id, future = await asyncio.wait_for(sent, self.outbound.ttl)
+        return await self._wait_for_result(msg_id, future, timeout)
+
+    def _get_service_priority(self, command):
+        """Get the rate limit priority of a service call from its domain and entities."""
+        domains = {command["domain"]}
+        entity_ids = get_entity_ids(command["service_data"].get("entity_id", []))
+        domains.update(entity_id.split(".", 1)[0] for entity_id in entity_ids)
+        return self.rate_limiter.get_priority(domains)
 
     async def disconnect(self):
+        for key in list(self.service_batches):
+            await self._flush_service_batch(key)
+
+        # Give any queued commands a chance to be sent before shutting down.
+        deadline = time.monotonic() + self.config.get("outbound_drain_timeout", 5)
+        while self.outbound and self.listening and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.outbound:
+            _LOGGER.warning(
+                "Discarding %d commands which couldn't be sent to Home Assistant.",
+                len(self.outbound),
+            )
+            self.outbound.clear()
+
         self.discovery_info = None
         self.listening = False
-        await self.connection.close()
+        if self.rate_limiter is not None:
+            self.rate_limiter.stop()
+        for _, handle in self.debounced.values():
+            handle.cancel()
+        self.debounced = {}
+        await self.dispatcher.stop()
+        if self.connection is not None:
+            await self.connection.close()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
@@ -0,0 +1,50 @@
+import collections
+import time
+
+DEFAULT_TTLS = {"config": 300, "services": 300, "discovery_info": 300, "events": 300}
+
+
+class ResponseCache:
+    """A TTL and LRU bounded cache of API responses.
+
+    Only responses for endpoints with a TTL are cached. Once ``size`` responses are
+    cached the least recently used one is evicted to make room for a new one. The
+    ``hits`` and ``misses`` attributes count lookups for cacheable endpoints.
+
+    """
+
+    def __init__(self, ttls=None, size=128):
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.size = size
+        self.responses = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_ttl(self, endpoint):
+        return self.ttls.get(endpoint)
+
+    def get(self, key):
+        """Get a cached response, or ``None`` if it isn't cached or has expired."""
+        item = self.responses.get(key)
+        if item is not None and item[0] > time.monotonic():
+            self.responses.move_to_end(key)
+            self.hits += 1
+            return item[1]
+        if item is not None:
+            del self.responses[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, response, ttl):
+        self.responses[key] = (time.monotonic() + ttl, response)
+        self.responses.move_to_end(key)
+        while len(self.responses) > self.size:
+            self.responses.popitem(last=False)
+
+    def invalidate(self, endpoint=None):
+        """Remove cached responses for an endpoint, or all responses."""
+        if endpoint is None:
+            self.responses.clear()
+            return
+        for key in [key for key in self.responses if key[0] == endpoint]:
+            del self.responses[key]
@@ -0,0 +1,40 @@
+import json
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+CODECS = ["json", "orjson", "ujson"]
+
+
+class JSONCodec:
+    """Encode and decode JSON messages exchanged with Home Assistant.
+
+    The standard library :mod:`json` module is used by default. The faster ``orjson`` and
+    ``ujson`` libraries can be used instead if they are installed.
+
+    """
+
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+
+def get_codec(name="json"):
+    """Get a JSON codec by name, falling back to the standard library if unavailable."""
+    if name == "orjson":
+        try:
+            import orjson
+
+            return JSONCodec(
+                "orjson", orjson.loads, lambda obj: orjson.dumps(obj).decode("utf-8")
+            )
+        except ImportError:
+            _LOGGER.warning("orjson is not installed, falling back to json.")
+    if name == "ujson":
+        try:
+            import ujson
+
+            return JSONCodec("ujson", ujson.loads, ujson.dumps)
+        except ImportError:
+            _LOGGER.warning("ujson is not installed, falling back to json.")
+    return JSONCodec("json", json.loads, json.dumps)
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+OVERFLOW_POLICIES = ["block", "drop_oldest", "drop_newest"]
+
+
+class EventDispatcher:
+    """Bounded queues of events drained by a pool of workers.
+
+    Events read from the Home Assistant websocket are put on a queue and parsed by
+    opsdroid in the workers, so a slow skill does not stop the connector reading from
+    the websocket.
+
+    Each worker drains its own queue, or lane, and events are assigned to a lane by
+    hashing a key such as the entity ID. This means events for one entity are always
+    handled in the order they arrived while events for different entities are handled
+    concurrently.
+
+    When a lane is full the overflow policy decides what happens:
+
+    * ``block`` waits for space in the lane, which stops reading from the websocket.
+      ``blocking`` is the number of events currently waiting for space and ``blocked``
+      counts every event which has had to wait.
+    * ``drop_oldest`` discards the oldest queued event to make room for the new one.
+    * ``drop_newest`` discards the new event.
+
+    """
+
+    def __init__(self, handler, workers=4, maxsize=1000, overflow="block"):
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.queues = []
+        self.tasks = []
+        self.dropped = 0
+        self.blocked = 0
+        self.blocking = 0
+
+    @property
+    def depth(self):
+        """The number of events waiting to be handled."""
+        return sum(queue.qsize() for queue in self.queues)
+
+    def start(self):
+        if self.tasks:
+            return
+        self.queues = [asyncio.Queue(maxsize=self.maxsize) for _ in range(self.workers)]
+        self.tasks = [
+            asyncio.ensure_future(self._worker(queue)) for queue in self.queues
+        ]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def put(self, event, key=None):
+        """Queue an event on the lane for ``key``."""
+        queue = self.queues[hash(key) % len(self.queues)]
+        if not queue.full():
+            queue.put_nowait(event)
+            return
+        if self.overflow == "block":
+            self.blocked += 1
+            self.blocking += 1
+            try:
+                await queue.put(event)
+            finally:
+                self.blocking -= 1
+            return
+
+        self.dropped += 1
+        if self.overflow == "drop_oldest":
+            queue.get_nowait()
+            queue.task_done()
+            queue.put_nowait(event)
+        _LOGGER.debug("Event queue full, dropped an event.")
+
+    async def _worker(self, queue):
+        while True:
+            event = await queue.get()
+            try:
+                await self.handler(event)
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Error handling Home Assistant event.")
+            finally:
+                queue.task_done()
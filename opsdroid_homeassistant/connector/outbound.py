@@ -0,0 +1,86 @@
+import asyncio
+import collections
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class OutboundQueue:
+    """A bounded queue of commands waiting to be sent to Home Assistant.
+
+    Commands made while the websocket is disconnected are held here and sent in order
+    once the connector has authenticated again. Commands which have been queued for
+    longer than ``ttl`` seconds are discarded, and if the queue is full the oldest
+    command is dropped to make room.
+
+    The ``queued``, ``expired``, ``dropped`` and ``flushed`` attributes count commands
+    for monitoring.
+
+    """
+
+    def __init__(self, maxsize=100, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = collections.deque()
+        self.queued = 0
+        self.expired = 0
+        self.dropped = 0
+        self.flushed = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, command, wait=False):
+        """Queue a command.
+
+        Args:
+            command: The command dictionary, without an ``id``.
+            wait: Whether the caller wants to know when the command has been sent.
+
+        Returns:
+            If ``wait`` is set, a future which resolves to the message ID and result
+            future of the command once it has been sent, else ``None``.
+
+        """
+        if len(self.items) >= self.maxsize:
+            _, _, sent = self.items.popleft()
+            self._fail(sent)
+            self.dropped += 1
+            _LOGGER.warning("Outbound command queue full, dropped the oldest command.")
+        sent = asyncio.get_event_loop().create_future() if wait else None
+        self.items.append((time.monotonic(), command, sent))
+        self.queued += 1
+        return sent
+
+    def pop(self):
+        """Get the next command which has not expired.
+
+        Returns:
+            A ``(command, sent)`` tuple, or ``None`` if the queue is empty.
+
+        """
+        while self.items:
+            queued_at, command, sent = self.items.popleft()
+            if sent is not None and sent.cancelled():
+                continue
+            if time.monotonic() - queued_at > self.ttl:
+                self._fail(sent)
+                self.expired += 1
+                continue
+            return command, sent
+        return None
+
+    def clear(self):
+        """Discard all queued commands."""
+        for _, _, sent in self.items:
+            self._fail(sent)
+        self.expired += len(self.items)
+        self.items.clear()
+
+    @staticmethod
+    def _fail(sent):
+        if sent is not None and not sent.done():
+            sent.set_exception(
+                asyncio.TimeoutError("Command expired before it could be sent.")
+            )
@@ -0,0 +1,90 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+DEFAULT_PRIORITIES = {
+    "lock": 0,
+    "alarm_control_panel": 0,
+    "notify": 2,
+    "persistent_notification": 2,
+}
+
+
+class RateLimiter:
+    """A token bucket rate limiter with priority classes.
+
+    Tokens are added to the bucket at ``rate`` per second up to ``burst`` tokens and each
+    call uses one token. When the bucket is empty calls wait in priority order, lower
+    numbers first, so important calls such as locking a door jump ahead of less
+    important ones like notifications.
+
+    ``burst`` defaults to ``rate`` and is at least one, otherwise the bucket could never
+    hold a whole token. The ``throttled`` attribute counts calls which had to wait and
+    ``delayed`` is the total number of seconds they waited.
+
+    """
+
+    def __init__(self, rate, burst=None, priorities=None):
+        self.rate = rate
+        self.burst = max(1, burst if burst is not None else rate)
+        self.priorities = dict(DEFAULT_PRIORITIES, **(priorities or {}))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waiting = []
+        self.throttled = 0
+        self.delayed = 0.0
+        self._counter = itertools.count()
+        self._task = None
+
+    def get_priority(self, domains, default=1):
+        """Get the highest priority, i.e lowest number, of a collection of domains."""
+        return min(
+            (self.priorities.get(domain, default) for domain in domains),
+            default=default,
+        )
+
+    async def acquire(self, priority=1):
+        """Wait until a call at the given priority is allowed."""
+        self._refill()
+        if not self.waiting and self.tokens >= 1:
+            self.tokens -= 1
+            return
+
+        self.throttled += 1
+        start = time.monotonic()
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self._counter), future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._release())
+        try:
+            await future
+        finally:
+            self.delayed += time.monotonic() - start
+
+    def stop(self):
+        """Stop releasing calls and fail any which are still waiting."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for _, _, future in self.waiting:
+            if not future.done():
+                future.set_exception(ConnectionError("The rate limiter was stopped."))
+        self.waiting = []
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def _release(self):
+        while self.waiting:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            _, _, future = heapq.heappop(self.waiting)
+            if future.done():
+                continue
+            self.tokens -= 1
+            future.set_result(None)
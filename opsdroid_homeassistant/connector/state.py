@@ -0,0 +1,302 @@
+import sys
+import time
+
+import arrow
+
+PRESENCE_STATES = ("home", "not_home")
+
+
+def get_presence_zone(state):
+    """Get whether a device tracker state is ``home``, ``not_home`` or ``other``."""
+    return state if state in PRESENCE_STATES else "other"
+
+
+def count_presence(states):
+    """Count the device trackers which are ``home``, ``not_home`` or in another zone."""
+    presence = {"home": 0, "not_home": 0, "other": 0}
+    for state in states:
+        presence[get_presence_zone(state["state"])] += 1
+    return presence
+
+
+def get_presence_flags(presence):
+    """Work out whether anyone, everyone or nobody is home from device tracker counts."""
+    total = sum(presence.values())
+    return {
+        "anyone_home": presence["home"] > 0,
+        "everyone_home": presence["home"] == total,
+        "nobody_home": presence["not_home"] == total,
+    }
+
+
+class HassState:
+    """A compact record of the state of a Home Assistant entity.
+
+    Entity IDs, domains and states are interned as the same strings repeat across
+    thousands of entities, and the ``last_changed`` and ``last_updated`` timestamps are
+    only parsed into datetimes when they are first accessed. Context is not kept.
+
+    For compatibility with the state dictionaries returned by the Home Assistant API the
+    record can also be read like a dictionary, e.g ``state["attributes"]``.
+
+    """
+
+    __slots__ = (
+        "entity_id",
+        "domain",
+        "state",
+        "attributes",
+        "_last_changed",
+        "_last_updated",
+        "_last_changed_datetime",
+        "_last_updated_datetime",
+    )
+    _keys = ("entity_id", "state", "attributes", "last_changed", "last_updated")
+
+    def __init__(self, entity_id, state, attributes, last_changed, last_updated):
+        self.entity_id = sys.intern(entity_id)
+        self.domain = sys.intern(entity_id.split(".", 1)[0])
+        self.state = sys.intern(state)
+        self.attributes = attributes
+        self._last_changed = last_changed
+        self._last_updated = last_updated
+        self._last_changed_datetime = None
+        self._last_updated_datetime = None
+
+    @classmethod
+    def from_dict(cls, state, attributes=None):
+        """Create a record from a state dictionary.
+
+        Args:
+            state: The state dictionary from the Home Assistant API or an event.
+            attributes: If set, only the attributes named in this collection are kept.
+
+        """
+        state_attributes = state.get("attributes", {})
+        if attributes is not None:
+            state_attributes = {
+                key: value
+                for key, value in state_attributes.items()
+                if key in attributes
+            }
+        return cls(
+            state["entity_id"],
+            state["state"],
+            state_attributes,
+            state.get("last_changed"),
+            state.get("last_updated"),
+        )
+
+    @property
+    def last_changed(self):
+        if self._last_changed_datetime is None and self._last_changed is not None:
+            self._last_changed_datetime = arrow.get(self._last_changed).datetime
+        return self._last_changed_datetime
+
+    @property
+    def last_updated(self):
+        if self._last_updated_datetime is None and self._last_updated is not None:
+            self._last_updated_datetime = arrow.get(self._last_updated).datetime
+        return self._last_updated_datetime
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        if key in ("last_changed", "last_updated"):
+            # Timestamps are returned as the strings sent by Home Assistant
+            return getattr(self, "_" + key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def as_dict(self):
+        """Return the state as a dictionary like those returned by the API."""
+        return {key: self[key] for key in self._keys}
+
+    def __repr__(self):
+        return "<HassState {}={}>".format(self.entity_id, self.state)
+
+
+class StateCache:
+    """An in-memory mirror of the Home Assistant state machine.
+
+    The cache is hydrated from a full snapshot of states when the connector authenticates
+    and is then kept current from the ``state_changed`` event stream. While the websocket
+    is disconnected the cache is marked as unsynced so that readers fall back to the API.
+
+    States are stored as :class:`HassState` records. ``attributes`` can map a domain to
+    the attribute names to keep for entities in that domain, all other attributes of
+    those entities are discarded. Domains which are not listed keep all attributes.
+
+    The states are also indexed by domain so that all the entities in a domain can be
+    looked up without scanning every entity, and ``presence`` keeps a running count of
+    the device trackers which are ``home``, ``not_home`` or in any ``other`` zone.
+
+    """
+
+    def __init__(self, attributes=None):
+        self.states = {}
+        self.domains = {}
+        self.presence = count_presence([])
+        self.stale = {}
+        self.synced = False
+        self.tracked = None
+        self.attributes = attributes or {}
+
+    @property
+    def complete(self):
+        """Whether the cache mirrors every entity rather than a tracked subset."""
+        return self.tracked is None
+
+    def covers(self, entity_id):
+        """Whether the cache is kept current for the given entity."""
+        return self.tracked is None or entity_id in self.tracked
+
+    def load(self, states, tracked=None):
+        """Replace the contents of the cache with a full snapshot of states.
+
+        When only a subset of entities is being watched for changes, ``tracked`` is the
+        set of their IDs and all other entities are left out of the cache.
+
+        """
+        self.tracked = tracked
+        self.states = {}
+        self.domains = {}
+        self.presence = count_presence([])
+        for state in states:
+            if self.covers(state["entity_id"]):
+                self._add(self._record(state))
+        self.synced = True
+
+    def update(self, entity_id, new_state):
+        """Apply a state change to the cache.
+
+        A ``new_state`` of ``None`` means the entity has been removed from Home Assistant.
+
+        """
+        if not self.covers(entity_id):
+            return
+        self.stale.pop(entity_id, None)
+        if new_state is None:
+            self._remove(entity_id)
+        else:
+            self._add(self._record(new_state))
+
+    def mark_stale(self, entity_ids, ttl):
+        """Mark entities as about to change, e.g because a service call was sent for them.
+
+        Stale entities should be read from Home Assistant instead of the cache until
+        their next state change arrives or ``ttl`` seconds have passed.
+
+        """
+        deadline = time.monotonic() + ttl
+        for entity_id in entity_ids:
+            self.stale[entity_id] = deadline
+
+    def is_stale(self, entity_id):
+        """Whether an entity has been marked as stale and has not changed since."""
+        deadline = self.stale.get(entity_id)
+        if deadline is None:
+            return False
+        if time.monotonic() < deadline:
+            return True
+        del self.stale[entity_id]
+        return False
+
+    def diff(self, states):
+        """Find the states in a snapshot which differ from those in the cache.
+
+        An entity has changed if its state or ``last_updated`` time differs from the cached
+        record, if it is not in the cache, or if it is in the cache but missing from the
+        snapshot because it has been removed. Entities which are not tracked are ignored.
+
+        Returns:
+            A list of ``(old_state, new_state)`` tuples where ``old_state`` is the cached
+            :class:`HassState` or ``None`` and ``new_state`` is the state dictionary or
+            ``None`` if the entity was removed.
+
+        """
+        changed = []
+        seen = set()
+        for new_state in states:
+            entity_id = new_state["entity_id"]
+            seen.add(entity_id)
+            if not self.covers(entity_id):
+                continue
+            old_state = self.states.get(entity_id)
+            if (
+                old_state is None
+                or old_state.state != new_state["state"]
+                or old_state._last_updated != new_state.get("last_updated")
+            ):
+                changed.append((old_state, new_state))
+        for entity_id, old_state in self.states.items():
+            if entity_id not in seen:
+                changed.append((old_state, None))
+        return changed
+
+    def resynced_old_state(self, old_state, new_state):
+        """Get a cached record as the ``old_state`` of a change found by :meth:`diff`.
+
+        The cache only keeps the allowed attributes for some domains, so the old values of
+        the other attributes aren't known. They are taken from ``new_state`` so that they
+        aren't reported as changed.
+
+        Returns:
+            A state dictionary, or ``None`` if ``old_state`` is ``None``.
+
+        """
+        if old_state is None:
+            return None
+        old_dict = old_state.as_dict()
+        if new_state is not None and old_state.domain in self.attributes:
+            kept = self.attributes[old_state.domain]
+            old_dict["attributes"] = {
+                key: value
+                for key, value in (new_state.get("attributes") or {}).items()
+                if key not in kept
+            }
+            old_dict["attributes"].update(old_state.attributes)
+        return old_dict
+
+    def _record(self, state):
+        domain = state["entity_id"].split(".", 1)[0]
+        return HassState.from_dict(state, self.attributes.get(domain))
+
+    def _add(self, record):
+        self._remove(record.entity_id)
+        self.states[record.entity_id] = record
+        self.domains.setdefault(record.domain, {})[record.entity_id] = record
+        if record.domain == "device_tracker":
+            self.presence[get_presence_zone(record.state)] += 1
+
+    def _remove(self, entity_id):
+        record = self.states.pop(entity_id, None)
+        if record is None:
+            return
+        domain = self.domains[record.domain]
+        del domain[entity_id]
+        if not domain:
+            del self.domains[record.domain]
+        if record.domain == "device_tracker":
+            self.presence[get_presence_zone(record.state)] -= 1
+
+    def get(self, entity_id):
+        return self.states.get(entity_id)
+
+    def all(self):
+        return list(self.states.values())
+
+    def domain(self, domain):
+        """Get the states of all entities in a domain."""
+        return list(self.domains.get(domain, {}).values())
+
+    def invalidate(self):
+        self.synced = False
@@ -0,0 +1,56 @@
+import re
+
+# Skip over strings and other values to the next bracket.
+_BRACKET = re.compile(rb'(?:[^"\[\]{}]|"(?:[^"\\]|\\.)*")*([\[\]{}])', re.DOTALL)
+_ENTITY_ID = re.compile(rb'"entity_id"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+class JSONArrayStream:
+    """Incrementally split a streamed JSON array into its raw elements.
+
+    Chunks of the response body are fed in as they arrive and the raw bytes of each
+    complete object in the top level array are returned, so that elements can be
+    filtered before being decoded and the whole response never has to be held in memory.
+
+    """
+
+    def __init__(self):
+        self.buffer = b""
+        self.pos = 0
+        self.depth = 0
+        self.start = None
+
+    def feed(self, chunk):
+        """Add a chunk of the response and return the elements completed by it."""
+        buffer = self.buffer + chunk
+        pos, depth, start = self.pos, self.depth, self.start
+        elements = []
+        while True:
+            bracket = _BRACKET.match(buffer, pos)
+            if bracket is None:
+                # The next bracket, or the end of a string, is in a later chunk.
+                break
+            pos = bracket.end()
+            if buffer[bracket.start(1)] in b"[{":
+                depth += 1
+                if depth == 2:
+                    start = bracket.start(1)
+            else:
+                depth -= 1
+                if depth == 1 and start is not None:
+                    elements.append(buffer[start:pos])
+                    start = None
+
+        # Drop everything before the element we are part way through.
+        keep = start if start is not None else pos
+        self.buffer = buffer[keep:]
+        self.pos = pos - keep
+        self.start = 0 if start is not None else None
+        self.depth = depth
+        return elements
+
+
+def get_entity_id(element):
+    """Get the entity ID from the raw bytes of a state without decoding it all."""
+    match = _ENTITY_ID.search(element)
+    return match.group(1).decode("utf-8") if match is not None else None
@@ -0,0 +1,86 @@
+import datetime
+import math
+
+J2000 = 2451545.0
+UNIX_EPOCH_JULIAN = 2440587.5
+OBLIQUITY = math.radians(23.4397)
+
+
+def get_sun_events(latitude, longitude, day, elevation=0):
+    """Calculate the sunrise and sunset on a day using the NOAA sunrise equation.
+
+    The result is usually within a minute of the times Home Assistant reports.
+
+    Args:
+        latitude: Latitude of the location in degrees.
+        longitude: Longitude of the location in degrees, east is positive.
+        day: A :class:`datetime.date`, the day is counted from noon UTC.
+        elevation: Elevation of the location in metres.
+
+    Returns:
+        A ``(sunrise, sunset)`` tuple of UTC datetimes, or ``None`` if the sun doesn't
+        rise or set on that day.
+
+    """
+    n = day.toordinal() - datetime.date(2000, 1, 1).toordinal()
+    mean_solar_time = n - longitude / 360
+    anomaly = math.radians((357.5291 + 0.98560028 * mean_solar_time) % 360)
+    centre = (
+        1.9148 * math.sin(anomaly)
+        + 0.02 * math.sin(2 * anomaly)
+        + 0.0003 * math.sin(3 * anomaly)
+    )
+    ecliptic_longitude = math.radians(
+        (math.degrees(anomaly) + centre + 180 + 102.9372) % 360
+    )
+    transit = (
+        J2000
+        + mean_solar_time
+        + 0.0053 * math.sin(anomaly)
+        - 0.0069 * math.sin(2 * ecliptic_longitude)
+    )
+    declination = math.asin(math.sin(ecliptic_longitude) * math.sin(OBLIQUITY))
+
+    # The sun is up when its centre is 0.833 degrees below the horizon because of
+    # refraction and the size of its disc, and earlier still from higher up.
+    altitude = math.radians(-0.833 - 2.076 * math.sqrt(max(elevation, 0)) / 60)
+    latitude = math.radians(latitude)
+    cos_hour_angle = (
+        math.sin(altitude) - math.sin(latitude) * math.sin(declination)
+    ) / (math.cos(latitude) * math.cos(declination))
+    if not -1 <= cos_hour_angle <= 1:
+        return None
+    hour_angle = math.degrees(math.acos(cos_hour_angle))
+    return (
+        _julian_to_datetime(transit - hour_angle / 360),
+        _julian_to_datetime(transit + hour_angle / 360),
+    )
+
+
+def get_next_sun_events(latitude, longitude, elevation=0, now=None):
+    """Calculate the next sunrise and sunset after ``now``.
+
+    Returns:
+        A dictionary with the ``next_rising`` and ``next_setting`` datetimes, either of
+        which is ``None`` if it doesn't happen within the next year.
+
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    next_events = {"next_rising": None, "next_setting": None}
+    day = now.date() - datetime.timedelta(days=1)
+    for _ in range(367):
+        events = get_sun_events(latitude, longitude, day, elevation)
+        if events is not None:
+            for key, event_time in zip(next_events, events):
+                if next_events[key] is None and event_time > now:
+                    next_events[key] = event_time
+        if None not in next_events.values():
+            break
+        day += datetime.timedelta(days=1)
+    return next_events
+
+
+def _julian_to_datetime(julian):
+    return datetime.datetime.fromtimestamp(
+        (julian - UNIX_EPOCH_JULIAN) * 86400, datetime.timezone.utc
+    )
@@ -1,10 +1,30 @@
-from typing import Callable
+from typing import Callable, List, Optional
 
 from opsdroid.matchers import match_event
-from ..connector import HassEvent
+from ..connector import HassEvent, HassPresenceChanged
 
 
-def match_hass_state_changed(entity_id: str, **kwargs) -> Callable:
+class _AnyOf:
+    """Compares equal to a list of attribute names which contains any of ours."""
+
+    def __init__(self, names):
+        self.names = frozenset(names)
+
+    def __eq__(self, other):
+        return other is not None and not self.names.isdisjoint(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "_AnyOf({!r})".format(sorted(self.names))
+
+
+def match_hass_state_changed(
+    entity_id: str, attributes: Optional[List[str]] = None, **kwargs
+) -> Callable:
     """A matcher for state changes in Home Assistant.
 
     When an entity changes state in Home Assistant an event is triggered in Opsdroid.
@@ -39,14 +59,57 @@ def match_hass_state_changed(entity_id: str, **kwargs) -> Callable:
         For sunrise and sunset triggers you can also use the :func:`match_sunrise` and
         :func:`match_sunset` helper matchers.
 
+    To trigger when some attributes change, whether or not the state has changed, pass their
+    names as ``attributes``. The skill is triggered when any of them are added, removed or
+    change value::
+
+        class BrightnessSkill(HassSkill):
+
+            @match_hass_state_changed("light.kitchen", attributes=["brightness"])
+            async def brightness_changed(self, event):
+                await self.notify("The kitchen light has been dimmed")
+
     Args:
         entity_id: The full domain and name of the entity you want to watch. e,g ``sun.sun``
+        attributes (optional): Attribute names to watch for changes instead of the state.
         state (optional): The state you want to watch for. e.g ``on``
 
     """
+    if attributes:
+        return match_event(
+            HassEvent,
+            entity_id=entity_id,
+            attributes_changed=_AnyOf(attributes),
+            **kwargs
+        )
     return match_event(HassEvent, entity_id=entity_id, changed=True, **kwargs)
 
 
+def match_presence_changed(**kwargs) -> Callable:
+    """A matcher for changes in who is home.
+
+    The connector counts the device trackers which are home and triggers this matcher
+    when anyone, everyone or nobody being home changes, so skills don't need to poll
+    :meth:`HassSkill.anyone_home` and friends::
+
+        from opsdroid_homeassistant import HassSkill, match_presence_changed
+
+
+        class AwaySkill(HassSkill):
+
+            @match_presence_changed(nobody_home=True)
+            async def lights_off_when_everyone_leaves(self, event):
+                await self.turn_off("group.all_lights")
+
+    Args:
+        anyone_home (optional): Only trigger when anyone being home is this value.
+        everyone_home (optional): Only trigger when everyone being home is this value.
+        nobody_home (optional): Only trigger when nobody being home is this value.
+
+    """
+    return match_event(HassPresenceChanged, **kwargs)
+
+
 match_sunrise = match_hass_state_changed("sun.sun", state="above_horizon")
 match_sunrise.__doc__ = """A matcher to trigger skills on sunrise.
 
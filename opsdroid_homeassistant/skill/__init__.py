@@ -1,10 +1,9 @@
-import arrow
 from datetime import datetime
 import logging
 
 from opsdroid.skill import Skill
 
-from ..connector import HassServiceCall
+from ..connector import HassServiceCall, HassState, get_presence_flags
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -54,16 +53,35 @@ class HassSkill(Skill):
             ]
         return self._hass
 
-    async def call_service(self, domain: str, service: str, *args, **kwargs):
+    async def call_service(
+        self,
+        domain: str,
+        service: str,
+        *args,
+        _wait: bool = False,
+        _timeout: float = None,
+        **kwargs
+    ):
         """Send a service call to Home Assistant.
 
         Build your own service call to any domain and service.
 
+        By default the call is sent without waiting for Home Assistant to respond. Set ``_wait``
+        to wait for the result, in which case a failed call raises
+        :class:`opsdroid_homeassistant.HassCommandError`. The ``_wait`` and ``_timeout`` options
+        are also accepted by all of the service helpers such as :meth:`turn_on`. They start
+        with an underscore so they can't clash with service parameters such as ``timeout``.
+
         Args:
             domain: The Home Assistant service domain. E.g ``media_player``.
             service: The service to call. E.g ``media_pause``
+            _wait (optional): Wait for Home Assistant to return the result of the call.
+            _timeout (optional): Seconds to wait for the result before raising ``asyncio.TimeoutError``.
             **kwargs: Service parameters are passed as kwargs. E.g ``entity_id="media_player.living_room_sonos"``
 
+        Returns:
+            The result of the service call if ``_wait`` is set, else ``None``.
+
         Note:
             For common operations such and turning off and on entities see
             the :meth:`turn_on` and :meth:`turn_off` helper functions.
@@ -73,13 +91,23 @@ class HassSkill(Skill):
 
                 >>> await self.call_service("climate", "set_hvac_mode", entity_id="climate.living_room", hvac_mode="off")
         """
-        await self.hass.send(HassServiceCall(domain, service, kwargs))
+        return await self.hass.send(
+            HassServiceCall(domain, service, kwargs, wait=_wait, timeout=_timeout)
+        )
 
-    async def get_state(self, entity: str):
+    async def get_state(self, entity: str, fresh: bool = False):
         """Get the state of an entity.
 
+        States are read from the connector's state cache, which is updated from the state
+        changes Home Assistant sends over the websocket. Entities which you have just sent a
+        service call for, e.g with :meth:`turn_on` or :meth:`set_value`, are read from Home
+        Assistant until their change arrives. Changes made any other way, such as by
+        automations or other skills, can take a moment to reach the cache. Set ``fresh``
+        to always query Home Assistant directly.
+
         Args:
             entity: The ID of the entity to get the state for.
+            fresh (optional): Skip the state cache and query Home Assistant.
 
         Returns:
             The state of the entity.
@@ -90,8 +118,10 @@ class HassSkill(Skill):
                 >>> await self.get_state("sun.sun")
                 "above_horizon"
         """
-        state = await self.hass.query_api("states/" + entity)
+        state = await self.hass.get_state(entity, fresh=fresh)
         _LOGGER.debug(state)
+        if state is None:
+            return None
         return state.get("state", None)
 
     async def turn_on(self, entity_id: str, **kwargs):
@@ -175,49 +205,78 @@ class HassSkill(Skill):
             "notify", target, message=message, title=title, **kwargs
         )
 
-    async def sun_up(self):
+    async def sun_up(self, fresh: bool = False):
         """Check whether the sun is up.
 
         Returns:
             True if sun is up, else False.
 
         """
-        sun_state = await self.get_state("sun.sun")
+        sun_state = await self.get_state("sun.sun", fresh=fresh)
         return sun_state == "above_horizon"
 
-    async def sun_down(self):
+    async def sun_down(self, fresh: bool = False):
         """Check whether the sun is down.
 
         Returns:
             True if sun is down, else False.
 
         """
-        sun_state = await self.get_state("sun.sun")
+        sun_state = await self.get_state("sun.sun", fresh=fresh)
         return sun_state == "below_horizon"
 
-    async def sunrise(self):
+    async def sunrise(self, fresh: bool = False):
         """Get the timestamp for the next sunrise.
 
         Returns:
             A Datetime object of next sunrise.
 
         """
-        sun_state = await self.hass.query_api("states/sun.sun")
-        sunrise = arrow.get(sun_state["attributes"]["next_rising"])
-        return sunrise.datetime
+        sun_times = await self.hass.get_sun_times(fresh=fresh)
+        return sun_times["next_rising"]
 
-    async def sunset(self):
+    async def sunset(self, fresh: bool = False):
         """Get the timestamp for the next sunset.
 
         Returns:
             A Datetime object of next sunset.
 
         """
-        sun_state = await self.hass.query_api("states/sun.sun")
-        sunset = arrow.get(sun_state["attributes"]["next_setting"])
-        return sunset.datetime
+        sun_times = await self.hass.get_sun_times(fresh=fresh)
+        return sun_times["next_setting"]
+
+    async def get_entities(self, domain: str, fresh: bool = False):
+        """Get a list of all entities in a domain from Home Assistant.
+
+        Args:
+            domain: The domain of the entities, e.g ``light``.
+            fresh (optional): Skip the state cache and always query Home Assistant.
+
+        Returns:
+            List of state dictionary objects.
+
+        Examples:
+
+            >>> await self.get_entities("light")
+            [{
+                "attributes": {
+                    "friendly_name": "Bed Light",
+                    "supported_features": 147
+                },
+                "entity_id": "light.bed_light",
+                "last_changed": "2020-01-03T20:27:55.001812+00:00",
+                "last_updated": "2020-01-03T20:27:55.001812+00:00",
+                "state": "off"
+            }]
+
+        """
+        states = await self.hass.get_states(fresh=fresh, domain=domain)
+        return [
+            entity.as_dict() if isinstance(entity, HassState) else entity
+            for entity in states
+        ]
 
-    async def get_trackers(self):
+    async def get_trackers(self, fresh: bool = False):
         """Get a list of tracker entities from Home Assistant.
 
         Returns:
@@ -234,11 +293,6 @@ class HassSkill(Skill):
                     "scanner": "NmapDeviceScanner",
                     "source_type": "router"
                 },
-                "context": {
-                    "id": "abc123",
-                    "parent_id": None,
-                    "user_id": None
-                },
                 "entity_id": "device_tracker.jacob",
                 "last_changed": "2020-01-03T20:27:55.001812+00:00",
                 "last_updated": "2020-01-03T20:27:55.001812+00:00",
@@ -246,46 +300,37 @@ class HassSkill(Skill):
             }]
 
         """
-        states = await self.hass.query_api("states")
-        device_trackers = [
-            entity
-            for entity in states
-            if entity["entity_id"].startswith("device_tracker.")
-        ]
-        return device_trackers
+        return await self.get_entities("device_tracker", fresh=fresh)
 
-    async def anyone_home(self):
+    async def anyone_home(self, fresh: bool = False):
         """Check if anyone is home.
 
         Returns:
             True if any tracker is set to ``home``, else False.
 
         """
-        trackers = await self.get_trackers()
-        home = [tracker["state"] == "home" for tracker in trackers]
-        return any(home)
+        presence = await self.hass.get_presence(fresh=fresh)
+        return get_presence_flags(presence)["anyone_home"]
 
-    async def everyone_home(self):
+    async def everyone_home(self, fresh: bool = False):
         """Check if everyone is home.
 
         Returns:
             True if all trackers are set to ``home``, else False.
 
         """
-        trackers = await self.get_trackers()
-        home = [tracker["state"] == "home" for tracker in trackers]
-        return all(home)
+        presence = await self.hass.get_presence(fresh=fresh)
+        return get_presence_flags(presence)["everyone_home"]
 
-    async def nobody_home(self):
+    async def nobody_home(self, fresh: bool = False):
         """Check if nobody is home.
 
         Returns:
             True if all trackers are set to ``not_home``, else False.
 
         """
-        trackers = await self.get_trackers()
-        not_home = [tracker["state"] == "not_home" for tracker in trackers]
-        return all(not_home)
+        presence = await self.hass.get_presence(fresh=fresh)
+        return get_presence_flags(presence)["nobody_home"]
 
     async def render_template(self, template: str) -> str:
         """Ask Home Assistant to render a template.
@@ -309,6 +354,4 @@ class HassSkill(Skill):
             Jacob is at home!
 
         """
-        return await self.hass.query_api(
-            "template", method="POST", decode_json=False, template=template
-        )
+        return await self.hass.render_template(template)
@@ -7,6 +7,7 @@ class TestSkill(HassSkill):
         super().__init__(opsdroid, config, *args, **kwargs)
         opsdroid.mock_skill = self
         self.kitchen_lights_changed = False
+        self.living_room_brightness_changed = False
 
     @match_regex(r"Turn on the light")
     async def lights_on(self, event):
@@ -23,3 +24,9 @@ class TestSkill(HassSkill):
     @match_hass_state_changed("light.kitchen_lights")
     async def listen_for_lights(self, event):
         self.kitchen_lights_changed = True
+
+    @match_hass_state_changed(
+        "light.living_room_rgbww_lights", attributes=["brightness"]
+    )
+    async def listen_for_brightness(self, event):
+        self.living_room_brightness_changed = True
@@ -1,8 +1,62 @@
+import json
 import pytest
+import sys
 
-from asyncio import sleep
+from asyncio import Event, TimeoutError, ensure_future, gather, sleep, wait_for
+from datetime import date, datetime, timezone
+from types import SimpleNamespace
 
+from aiohttp.client_exceptions import ClientPayloadError, ServerDisconnectedError
 from opsdroid.events import Message
+from opsdroid.matchers import match_always, match_catchall, match_event
+from voluptuous import Invalid, Schema
+
+from opsdroid_homeassistant import (
+    HassCommandError,
+    HassConnector,
+    HassEvent,
+    HassPresenceChanged,
+    HassServiceCall,
+    match_hass_state_changed,
+)
+from opsdroid_homeassistant.connector import CONFIG_SCHEMA
+from opsdroid_homeassistant.connector.cache import ResponseCache
+from opsdroid_homeassistant.connector.codec import get_codec
+from opsdroid_homeassistant.connector.dispatch import EventDispatcher
+from opsdroid_homeassistant.connector.outbound import OutboundQueue
+from opsdroid_homeassistant.connector.ratelimit import RateLimiter
+from opsdroid_homeassistant.connector.state import HassState, StateCache
+from opsdroid_homeassistant.connector.stream import JSONArrayStream, get_entity_id
+from opsdroid_homeassistant.connector.sun import get_next_sun_events, get_sun_events
+
+
+def make_connector(**config):
+    """Create a connector which isn't connected to Home Assistant."""
+    return HassConnector(
+        dict({"token": "token", "url": "http://localhost:8123/"}, **config)
+    )
+
+
+class FakeWebsocket:
+    """Records the messages a connector sends instead of sending them."""
+
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    async def send_json(self, data, dumps=None):
+        self.sent.append(data)
+
+    async def close(self):
+        self.closed = True
+
+
+def make_connected(**config):
+    """Create a connector which behaves as if it has authenticated."""
+    connector = make_connector(**config)
+    connector.connection = FakeWebsocket()
+    connector.authenticated = True
+    return connector
 
 
 @pytest.mark.asyncio
@@ -15,3 +69,1001 @@ async def test_attributes(connector):
 async def test_connect(connector):
     assert connector.listening
     assert "version" in connector.discovery_info
+
+
+@pytest.mark.asyncio
+async def test_query_api_reuses_session(connector):
+    session = connector.session
+    assert session is not None
+
+    await connector.query_api("discovery_info")
+    await connector.query_api("config")
+    assert connector.session is session
+    assert not session.closed
+
+
+@pytest.mark.asyncio
+async def test_websocket_queries(connector):
+    assert connector.authenticated
+
+    config = await connector.get_config()
+    assert "location_name" in config
+
+    services = await connector.get_services()
+    assert "turn_on" in services["homeassistant"]
+
+    states = await connector.get_states(fresh=True)
+    assert "sun.sun" in [state["entity_id"] for state in states]
+
+
+@pytest.mark.asyncio
+async def test_event_queue(connector):
+    assert connector.dispatcher.tasks
+    assert connector.event_queue_depth == 0
+    assert connector.dispatcher.dropped == 0
+
+
+async def fill_dispatcher(overflow):
+    """Queue three events on a single lane which only has room for one."""
+    release = Event()
+    handled = []
+
+    async def handler(event):
+        await release.wait()
+        handled.append(event)
+
+    dispatcher = EventDispatcher(handler, workers=1, maxsize=1, overflow=overflow)
+    dispatcher.start()
+    await dispatcher.put(1)
+    await sleep(0)  # The worker takes the first event and waits in the handler.
+    await dispatcher.put(2)
+    await dispatcher.put(3)
+    assert dispatcher.dropped == 1
+    assert dispatcher.depth == 1
+    release.set()
+    await dispatcher.queues[0].join()
+    await dispatcher.stop()
+    return handled
+
+
+@pytest.mark.asyncio
+async def test_event_queue_lanes():
+    release = Event()
+    handled = []
+
+    async def handler(event):
+        key, number = event
+        if key == slow:
+            # Earlier events take longer, so they would finish last if run concurrently.
+            await release.wait()
+            await sleep(0.01 * (3 - number))
+        handled.append(event)
+
+    dispatcher = EventDispatcher(handler, workers=4, maxsize=10)
+    dispatcher.start()
+    # String hashes change between runs, so pick two keys which use different lanes.
+    slow = "light.slow"
+    fast = next(
+        "light.fast_{}".format(i)
+        for i in range(100)
+        if hash("light.fast_{}".format(i)) % 4 != hash(slow) % 4
+    )
+    for number in range(3):
+        await dispatcher.put((slow, number), key=slow)
+        await dispatcher.put((fast, number), key=fast)
+    await sleep(0.01)
+
+    # The fast entity's events are handled while the slow one's are waiting.
+    assert handled == [(fast, 0), (fast, 1), (fast, 2)]
+    release.set()
+    await gather(*(queue.join() for queue in dispatcher.queues))
+    assert [event for event in handled if event[0] == slow] == [
+        (slow, 0),
+        (slow, 1),
+        (slow, 2),
+    ]
+    await dispatcher.stop()
+
+
+@pytest.mark.asyncio
+async def test_event_queue_drop_oldest():
+    assert await fill_dispatcher("drop_oldest") == [1, 3]
+
+
+@pytest.mark.asyncio
+async def test_event_queue_drop_newest():
+    assert await fill_dispatcher("drop_newest") == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_event_queue_block():
+    release = Event()
+
+    async def handler(event):
+        await release.wait()
+
+    dispatcher = EventDispatcher(handler, workers=1, maxsize=1, overflow="block")
+    dispatcher.start()
+    await dispatcher.put(1)
+    await sleep(0)
+    await dispatcher.put(2)
+    put = ensure_future(dispatcher.put(3))
+    await sleep(0.01)
+    assert not put.done()
+    assert dispatcher.blocking == 1
+    release.set()
+    await wait_for(put, 1)
+    assert dispatcher.blocking == 0
+    assert dispatcher.blocked == 1
+    assert dispatcher.dropped == 0
+    await dispatcher.stop()
+
+
+def test_event_workers_schema():
+    Schema(CONFIG_SCHEMA)({"token": "t", "url": "u", "event_workers": 1})
+    with pytest.raises(Invalid):
+        Schema(CONFIG_SCHEMA)({"token": "t", "url": "u", "event_workers": 0})
+    with pytest.raises(Invalid):
+        Schema(CONFIG_SCHEMA)({"token": "t", "url": "u", "event_queue_size": 0})
+
+
+def test_hass_event_from_state_changed():
+    msg = {
+        "type": "event",
+        "event": {
+            "event_type": "state_changed",
+            "data": {
+                "entity_id": "light.bed_light",
+                "old_state": {"state": "off"},
+                "new_state": {"state": "on"},
+            },
+        },
+    }
+    event = HassEvent.from_state_changed(msg, keep_raw_event=False)
+    assert event.raw_event is None
+    assert event.get_entity("entity_id") == "light.bed_light"
+    assert event.get_entity("state") == "on"
+    assert event.get_entity("old_state") == "off"
+    assert event.get_entity("changed")
+
+
+@pytest.mark.asyncio
+async def test_query_api_single_flight(connector):
+    responses = await gather(*[connector.query_api("states/sun.sun") for _ in range(5)])
+    assert all(response is responses[0] for response in responses)
+    assert not connector.inflight_requests
+
+
+def test_json_array_stream():
+    states = [
+        {"entity_id": "light.bed_light", "state": "on", "attributes": {"a": "}]"}},
+        {"entity_id": "sun.sun", "state": 'say "hi" {', "attributes": {"b": [1, 2]}},
+    ]
+    data = json.dumps(states).encode()
+    stream = JSONArrayStream()
+    elements = []
+    for i in range(0, len(data), 7):
+        elements += stream.feed(data[i : i + 7])
+    assert [json.loads(element) for element in elements] == states
+    assert get_entity_id(elements[1]) == "sun.sun"
+
+
+@pytest.mark.asyncio
+async def test_get_states_domain(connector):
+    lights = await connector.get_states(fresh=True, domain="light")
+    assert lights
+    assert all(state["entity_id"].startswith("light.") for state in lights)
+
+
+def test_state_cache_domains():
+    cache = StateCache()
+    cache.load(
+        [
+            {"entity_id": "light.bed_light", "state": "on"},
+            {"entity_id": "sun.sun", "state": "above_horizon"},
+        ]
+    )
+    cache.update("light.kitchen", {"entity_id": "light.kitchen", "state": "off"})
+    assert [s.entity_id for s in cache.domain("light")] == [
+        "light.bed_light",
+        "light.kitchen",
+    ]
+    cache.update("sun.sun", None)
+    assert cache.domain("sun") == []
+    assert "sun" not in cache.domains
+
+
+def test_hass_state():
+    state = {
+        "entity_id": "light.bed_light",
+        "state": "on",
+        "attributes": {"brightness": 180, "friendly_name": "Bed Light"},
+        "last_changed": "2020-01-03T20:27:55.001812+00:00",
+        "last_updated": "2020-01-03T20:27:55.001812+00:00",
+        "context": {"id": "abc"},
+    }
+    record = HassState.from_dict(state)
+    assert record.domain == "light"
+    assert record["state"] == "on"
+    assert record["attributes"]["brightness"] == 180
+    assert record["last_changed"] == "2020-01-03T20:27:55.001812+00:00"
+    assert record.last_changed == datetime(
+        2020, 1, 3, 20, 27, 55, 1812, tzinfo=timezone.utc
+    )
+    assert "last_updated" in record
+    assert "context" not in record
+    assert record.get("context", "missing") == "missing"
+    with pytest.raises(KeyError):
+        record["context"]
+    assert record.as_dict() == {
+        key: value for key, value in state.items() if key != "context"
+    }
+
+    record = HassState.from_dict({"entity_id": "sun.sun", "state": "below_horizon"})
+    assert record.last_changed is None
+    assert record.as_dict()["attributes"] == {}
+
+
+def test_state_cache_attributes():
+    cache = StateCache({"light": ["brightness"]})
+    attributes = {"brightness": 180, "friendly_name": "Bed Light"}
+    cache.load(
+        [
+            {"entity_id": "light.bed_light", "state": "on", "attributes": attributes},
+            {"entity_id": "switch.fan", "state": "on", "attributes": attributes},
+        ]
+    )
+    assert cache.get("light.bed_light")["attributes"] == {"brightness": 180}
+    assert cache.get("switch.fan")["attributes"] == attributes
+
+    cache.update(
+        "light.bed_light",
+        {"entity_id": "light.bed_light", "state": "off", "attributes": attributes},
+    )
+    assert cache.get("light.bed_light")["attributes"] == {"brightness": 180}
+
+
+def test_presence_counts():
+    cache = StateCache()
+    cache.load(
+        [
+            {"entity_id": "device_tracker.a", "state": "home"},
+            {"entity_id": "device_tracker.b", "state": "not_home"},
+            {"entity_id": "light.bed_light", "state": "on"},
+        ]
+    )
+    assert cache.presence == {"home": 1, "not_home": 1, "other": 0}
+    cache.update("device_tracker.a", {"entity_id": "device_tracker.a", "state": "work"})
+    cache.update("device_tracker.b", None)
+    assert cache.presence == {"home": 0, "not_home": 0, "other": 1}
+
+    event = HassPresenceChanged.from_presence(cache.presence)
+    assert not event.get_entity("anyone_home")
+    assert not event.get_entity("nobody_home")
+    assert event.get_entity("other") == 1
+
+
+def test_sun_events():
+    # London on the summer solstice, sunrise 03:43 and sunset 20:21 UTC.
+    sunrise, sunset = get_sun_events(51.5074, -0.1278, date(2024, 6, 21))
+    assert (sunrise.hour, sunrise.minute) == (3, 43)
+    assert (sunset.hour, sunset.minute) == (20, 21)
+
+    now = datetime(2024, 6, 21, 12, tzinfo=timezone.utc)
+    sun_times = get_next_sun_events(51.5074, -0.1278, now=now)
+    assert sun_times["next_setting"].date() == date(2024, 6, 21)
+    assert sun_times["next_rising"].date() == date(2024, 6, 22)
+
+    # The midnight sun in Svalbard.
+    assert get_sun_events(78.22, 15.65, date(2024, 6, 21)) is None
+
+
+@pytest.mark.asyncio
+async def test_sun_times_cached(connector):
+    sun_times = await connector.get_sun_times()
+    assert await connector.get_sun_times() is sun_times
+    assert await connector.get_sun_times(fresh=True) == sun_times
+
+
+def test_hass_event_attributes_changed():
+    msg = {
+        "type": "event",
+        "event": {
+            "event_type": "state_changed",
+            "data": {
+                "entity_id": "light.bed_light",
+                "old_state": {"state": "on", "attributes": {"a": 1, "b": 2}},
+                "new_state": {"state": "on", "attributes": {"a": 2, "c": 3}},
+            },
+        },
+    }
+    event = HassEvent.from_state_changed(msg)
+    assert not event.get_entity("changed")
+    assert sorted(event.get_entity("attributes_changed")) == ["a", "b", "c"]
+
+
+def record_service_commands(connector):
+    commands = []
+
+    async def send_service_command(command, wait, timeout):
+        commands.append((command["service"], command["service_data"].get("entity_id")))
+
+    connector._send_service_command = send_service_command
+    return commands
+
+
+@pytest.mark.asyncio
+async def test_service_batch_merges_entities():
+    connector = make_connector(service_batch_window=0.05)
+    commands = record_service_commands(connector)
+    for entity_id in ["light.a", "light.b", "light.c"]:
+        await connector.send_service_call(
+            HassServiceCall("light", "turn_on", {"entity_id": entity_id})
+        )
+    await sleep(0.1)
+    assert commands == [("turn_on", ["light.a", "light.b", "light.c"])]
+
+
+@pytest.mark.asyncio
+async def test_service_batch_keeps_order_per_entity():
+    connector = make_connector(service_batch_window=0.05)
+    commands = record_service_commands(connector)
+    for service in ["turn_on", "turn_off", "turn_on"]:
+        await connector.send_service_call(
+            HassServiceCall("light", service, {"entity_id": "light.a"})
+        )
+    await sleep(0.1)
+    assert commands == [
+        ("turn_on", "light.a"),
+        ("turn_off", "light.a"),
+        ("turn_on", "light.a"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_service_batch_toggles():
+    connector = make_connector(service_batch_window=0.05)
+    commands = record_service_commands(connector)
+    for entity_id in ["light.a", "light.b", "light.b"]:
+        await connector.send_service_call(
+            HassServiceCall("light", "toggle", {"entity_id": entity_id})
+        )
+    await sleep(0.1)
+    assert commands == [("toggle", ["light.a", "light.b"]), ("toggle", "light.b")]
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_priority():
+    limiter = RateLimiter(rate=50, burst=1)
+    order = []
+
+    async def call(name, priority):
+        await limiter.acquire(priority)
+        order.append(name)
+
+    await call("first", 1)
+    await gather(call("notify", 2), call("light", 1), call("lock", 0))
+    assert order == ["first", "lock", "light", "notify"]
+    assert limiter.throttled == 3
+    assert limiter.delayed > 0
+    limiter.stop()
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_slow_rate():
+    limiter = RateLimiter(rate=0.5)
+    assert limiter.burst == 1
+    await wait_for(limiter.acquire(), 0.1)
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_stop_fails_waiting():
+    limiter = RateLimiter(rate=0.1, burst=1)
+    await limiter.acquire()
+    waiting = ensure_future(limiter.acquire())
+    await sleep(0.01)
+    limiter.stop()
+    with pytest.raises(ConnectionError):
+        await wait_for(waiting, 0.1)
+
+
+def test_rate_limit_schema():
+    schema = Schema(CONFIG_SCHEMA)
+    schema({"token": "t", "url": "u", "rate_limit": {"rate": 0.5}})
+    for rate_limit in [{"rate": 0}, {"rate": 1, "burst": 0}]:
+        with pytest.raises(Invalid):
+            schema({"token": "t", "url": "u", "rate_limit": rate_limit})
+
+
+@pytest.mark.asyncio
+async def test_render_template_websocket():
+    connector = make_connected()
+
+    async def render(template, event):
+        rendering = ensure_future(connector.render_template(template))
+        await sleep(0)
+        msg_id = connector.connection.sent[-1]["id"]
+        await connector._handle_message(
+            {"id": msg_id, "type": "result", "success": True, "result": None}
+        )
+        await connector._handle_message({"id": msg_id, "type": "event", "event": event})
+        return msg_id, await rendering
+
+    _, rendered = await render("{{ 1 + 1 }}", {"result": 2})
+    assert rendered == "2"
+
+    with pytest.raises(HassCommandError):
+        await render("{{ 1 + }}", {"error": "Bad template", "level": "ERROR"})
+
+    # Renders which arrive after unsubscribing are ignored.
+    msg_id, _ = await render("{{ 2 }}", {"result": 2})
+    assert connector.connection.sent[-1]["type"] == "unsubscribe_events"
+    await connector._handle_message({"id": msg_id, "type": "event", "event": {}})
+
+
+@pytest.mark.asyncio
+async def test_service_call_marks_entities_stale():
+    connector = make_connected()
+    connector.state_cache.load([{"entity_id": "light.a", "state": "off"}])
+    await connector.send_service_call(
+        HassServiceCall("light", "turn_on", {"entity_id": "light.a, light.b"})
+    )
+    assert connector.state_cache.is_stale("light.a")
+    assert connector.state_cache.is_stale("light.b")
+
+    connector.state_cache.update("light.a", {"entity_id": "light.a", "state": "on"})
+    assert not connector.state_cache.is_stale("light.a")
+
+    connector.state_cache.mark_stale(["light.c"], 0)
+    assert not connector.state_cache.is_stale("light.c")
+
+
+@pytest.mark.asyncio
+async def test_outbound_queue_expiry_and_overflow():
+    queue = OutboundQueue(maxsize=2)
+    first = queue.put({"n": 1}, wait=True)
+    queue.put({"n": 2})
+    queue.put({"n": 3})
+    assert queue.dropped == 1
+    with pytest.raises(TimeoutError):
+        await first
+    assert queue.pop() == ({"n": 2}, None)
+
+    queue = OutboundQueue(ttl=0.05)
+    queue.put({"n": 1})
+    await sleep(0.1)
+    queue.put({"n": 2})
+    assert queue.pop() == ({"n": 2}, None)
+    assert queue.expired == 1
+    assert queue.pop() is None
+
+
+@pytest.mark.asyncio
+async def test_outbound_flush_order_and_wait():
+    connector = make_connector()
+    connector.connection = FakeWebsocket()
+    sent = [
+        ensure_future(
+            connector.send_service_call(
+                HassServiceCall("light", "turn_on", {"entity_id": entity_id}, wait=True)
+            )
+        )
+        for entity_id in ["light.a", "light.b"]
+    ]
+    await sleep(0)
+    assert len(connector.outbound) == 2
+
+    connector.authenticated = True
+    await connector._flush_outbound()
+    assert [msg["service_data"]["entity_id"] for msg in connector.connection.sent] == [
+        "light.a",
+        "light.b",
+    ]
+    assert connector.outbound.flushed == 2
+    for msg in connector.connection.sent:
+        await connector._handle_message(
+            {"id": msg["id"], "type": "result", "success": True, "result": msg["id"]}
+        )
+    assert await gather(*sent) == [msg["id"] for msg in connector.connection.sent]
+
+
+@pytest.mark.asyncio
+async def test_disconnect_drains_outbound():
+    connector = make_connector(outbound_drain_timeout=1)
+    connector.connection = FakeWebsocket()
+    connector.listening = True
+    await connector.send_service_call(
+        HassServiceCall("light", "turn_on", {"entity_id": "light.a"})
+    )
+
+    async def reconnect():
+        await sleep(0.05)
+        connector.authenticated = True
+        await connector._flush_outbound()
+
+    await gather(connector.disconnect(), reconnect())
+    assert len(connector.connection.sent) == 1
+    assert connector.connection.closed
+
+    connector = make_connector(outbound_drain_timeout=0.05)
+    connector.connection = FakeWebsocket()
+    connector.listening = True
+    await connector.send_service_call(
+        HassServiceCall("light", "turn_on", {"entity_id": "light.a"})
+    )
+    await connector.disconnect()
+    assert not connector.outbound
+    assert not connector.connection.sent
+
+
+def test_outbound_queue_size_schema():
+    with pytest.raises(Invalid):
+        Schema(CONFIG_SCHEMA)({"token": "t", "url": "u", "outbound_queue_size": 0})
+
+
+def test_response_cache():
+    cache = ResponseCache({"config": 300}, size=2)
+    assert cache.get_ttl("config") == 300
+    assert cache.get_ttl("states") is None
+
+    cache.set(("config", 1), "one", 300)
+    cache.set(("config", 2), "two", 300)
+    assert cache.get(("config", 1)) == "one"
+    cache.set(("config", 3), "three", 300)
+    assert cache.get(("config", 2)) is None
+    assert cache.get(("config", 1)) == "one"
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    cache.set(("config", 4), "four", -1)
+    assert cache.get(("config", 4)) is None
+    assert ("config", 4) not in cache.responses
+
+
+@pytest.mark.asyncio
+async def test_query_api_cache():
+    connector = make_connector(api_cache={"ttl": {"config": 300}})
+    requests = []
+
+    async def query_api(url, method, decode_json, params):
+        requests.append(url)
+        return {"requests": len(requests)}
+
+    connector._query_api = query_api
+    assert await connector.query_api("config") == {"requests": 1}
+    assert await connector.query_api("config") == {"requests": 1}
+    assert await connector.query_api("states") == {"requests": 2}
+    assert await connector.query_api("states") == {"requests": 3}
+    assert (connector.api_cache.hits, connector.api_cache.misses) == (1, 1)
+
+    connector.invalidate_api_cache("states")
+    assert await connector.query_api("config") == {"requests": 1}
+    connector.invalidate_api_cache("config")
+    assert await connector.query_api("config") == {"requests": 4}
+
+
+@pytest.mark.asyncio
+async def test_query_api_single_flight_shared():
+    connector = make_connector()
+    release = Event()
+    requests = []
+
+    async def query_api(url, method, decode_json, params):
+        requests.append(url)
+        await release.wait()
+        return {"requests": len(requests)}
+
+    connector._query_api = query_api
+    callers = [ensure_future(connector.query_api("config")) for _ in range(3)]
+    await sleep(0)
+    assert len(connector.inflight_requests) == 1
+
+    # A caller giving up doesn't cancel the request for the others.
+    callers[0].cancel()
+    await sleep(0)
+    release.set()
+    assert await gather(*callers[1:]) == [{"requests": 1}, {"requests": 1}]
+    assert len(requests) == 1
+    assert connector.inflight_requests == {}
+
+    assert await connector.query_api("config") == {"requests": 2}
+
+
+def test_state_cache_diff():
+    def state(entity_id, state, last_updated="1"):
+        return {"entity_id": entity_id, "state": state, "last_updated": last_updated}
+
+    cache = StateCache()
+    cache.load([state("light.a", "on"), state("light.b", "on"), state("light.c", "on")])
+    changes = cache.diff(
+        [state("light.a", "on"), state("light.b", "on", "2"), state("light.d", "on")]
+    )
+    assert [
+        (old and old.entity_id, new and new["entity_id"]) for old, new in changes
+    ] == [("light.b", "light.b"), (None, "light.d"), ("light.c", None)]
+
+    cache.load([state("light.a", "on"), state("light.b", "on")], tracked={"light.a"})
+    assert cache.diff([state("light.b", "off")]) == [(cache.get("light.a"), None)]
+
+
+@pytest.mark.asyncio
+async def test_resync_states():
+    connector = make_connector()
+    connector.state_cache.load(
+        [
+            {"entity_id": "light.a", "state": "on", "last_updated": "1"},
+            {"entity_id": "light.b", "state": "on", "last_updated": "1"},
+        ]
+    )
+    events = []
+
+    async def query_api(endpoint, **kwargs):
+        return [{"entity_id": "light.a", "state": "off", "last_updated": "2"}]
+
+    async def put(event, key=None):
+        events.append(event)
+
+    connector.query_api = query_api
+    connector.dispatcher.put = put
+    await connector._sync_states()
+
+    assert [
+        (event.get_entity("entity_id"), event.get_entity("state")) for event in events
+    ] == [("light.a", "off"), ("light.b", None)]
+    assert all(event.get_entity("resynced") for event in events)
+    assert all(event.get_entity("changed") for event in events)
+    assert connector.state_cache.get("light.b") is None
+
+
+@pytest.mark.asyncio
+async def test_resync_states_cache_attributes():
+    connector = make_connector(cache_attributes={"light": ["brightness", "color"]})
+
+    def light(last_updated, **attributes):
+        attributes["friendly_name"] = "Kitchen"
+        return {
+            "entity_id": "light.kitchen",
+            "state": "on",
+            "attributes": attributes,
+            "last_updated": last_updated,
+        }
+
+    connector.state_cache.load([light("1", brightness=100)])
+    events = record_events(connector)
+
+    async def query_api(endpoint, **kwargs):
+        return [light("2", brightness=100, color="red")]
+
+    connector.query_api = query_api
+    await connector._sync_states()
+
+    [event] = events
+    assert event.get_entity("attributes_changed") == ["color"]
+
+
+@pytest.mark.asyncio
+async def test_sync_states_error():
+    connector = make_connector()
+
+    async def query_api(endpoint, **kwargs):
+        raise ClientPayloadError("Response payload is not completed")
+
+    connector.query_api = query_api
+    await connector._sync_states()
+    assert not connector.state_cache.synced
+
+
+def state_changed(entity_id, old_state, new_state):
+    """Build a ``state_changed`` event message."""
+    return {
+        "type": "event",
+        "event": {
+            "event_type": "state_changed",
+            "data": {
+                "entity_id": entity_id,
+                "old_state": old_state and {"entity_id": entity_id, "state": old_state},
+                "new_state": new_state and {"entity_id": entity_id, "state": new_state},
+            },
+        },
+    }
+
+
+def record_events(connector):
+    events = []
+
+    async def put(event, key=None):
+        events.append(event)
+
+    connector.dispatcher.put = put
+    return events
+
+
+@pytest.mark.asyncio
+async def test_debounce():
+    connector = make_connector(debounce={"sensor.*_power": 0.05})
+    events = record_events(connector)
+    for old_state, new_state in [("1", "2"), ("2", "3"), ("3", "4")]:
+        await connector._handle_state_changed(
+            state_changed("sensor.kitchen_power", old_state, new_state)
+        )
+    await connector._handle_state_changed(state_changed("light.a", "off", "on"))
+    assert [event.get_entity("entity_id") for event in events] == ["light.a"]
+
+    await sleep(0.1)
+    assert len(events) == 2
+    assert events[1].get_entity("old_state") == "1"
+    assert events[1].get_entity("state") == "4"
+    assert connector.events_coalesced == 2
+    assert not connector.debounced
+
+
+async def answer_pings(connector, answer=True):
+    """Wait for the connector to send a ping and optionally send the pong."""
+    while not connector.connection.sent:
+        await sleep(0.005)
+    ping = connector.connection.sent.pop()
+    assert ping["type"] == "ping"
+    if answer:
+        await connector._handle_message({"id": ping["id"], "type": "pong"})
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_latency():
+    connector = make_connected(heartbeat_interval=0.01, heartbeat_timeout=0.05)
+    heartbeat = ensure_future(connector._heartbeat())
+    await answer_pings(connector)
+    await sleep(0.005)
+    assert connector.latency is not None
+    assert not connector.connection.closed
+    heartbeat.cancel()
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_timeout_closes():
+    connector = make_connected(heartbeat_interval=0.01, heartbeat_timeout=0.05)
+    heartbeat = ensure_future(connector._heartbeat())
+    await answer_pings(connector, answer=False)
+    await wait_for(heartbeat, 0.2)
+    assert connector.connection.closed
+    assert connector.latency is None
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_ignores_blocked_reader():
+    connector = make_connected(heartbeat_interval=0.01, heartbeat_timeout=0.05)
+    connector.dispatcher.blocking = 1
+    heartbeat = ensure_future(connector._heartbeat())
+    await answer_pings(connector, answer=False)
+    await sleep(0.1)
+    assert not heartbeat.done()
+    assert not connector.connection.closed
+    heartbeat.cancel()
+
+
+def test_reconnect_delay():
+    connector = make_connector(reconnect_delay=1, reconnect_max_delay=10)
+    for attempts, delay in [(1, 1), (2, 2), (3, 4), (4, 8), (5, 10), (100, 10)]:
+        connector.reconnect_attempts = attempts
+        for _ in range(20):
+            assert delay / 2 <= connector._get_reconnect_delay() <= delay
+
+
+def fake_ws_connect(connector, results):
+    """Stub the websocket connection with a result or exception for each URL."""
+    attempts = []
+
+    async def ws_connect(url):
+        attempts.append(url)
+        if isinstance(results[url], Exception):
+            raise results[url]
+        return results[url]
+
+    connector._ws_connect = ws_connect
+    return attempts
+
+
+@pytest.mark.asyncio
+async def test_connect_tries_last_url_first():
+    connector = make_connector()
+    api_url, proxy_url = connector.websocket_urls
+    ws = FakeWebsocket()
+    attempts = fake_ws_connect(
+        connector, {api_url: ServerDisconnectedError(), proxy_url: ws}
+    )
+
+    assert await connector._connect_websocket() is ws
+    assert attempts == [api_url, proxy_url]
+    assert connector.websocket_url == proxy_url
+
+    attempts.clear()
+    assert await connector._connect_websocket() is ws
+    assert attempts == [proxy_url]
+
+
+@pytest.mark.asyncio
+async def test_probe_websocket_urls():
+    connector = make_connector(probe_websocket_urls=True)
+    api_url, proxy_url = connector.websocket_urls
+    ws = FakeWebsocket()
+    fake_ws_connect(connector, {api_url: ServerDisconnectedError(), proxy_url: ws})
+    assert await connector._connect_websocket() is ws
+    assert connector.websocket_url == proxy_url
+
+    fake_ws_connect(
+        connector, {api_url: ServerDisconnectedError(), proxy_url: ValueError("bad")}
+    )
+    with pytest.raises(ValueError):
+        await connector._connect_websocket()
+
+
+def test_get_codec_falls_back_to_json(monkeypatch, caplog):
+    monkeypatch.setitem(sys.modules, "ujson", None)
+    codec = get_codec("ujson")
+    assert codec.name == "json"
+    assert "ujson is not installed" in caplog.text
+
+
+@pytest.mark.parametrize("name", ["json", "orjson"])
+def test_codec_bytes_frames(name):
+    if name != "json":
+        pytest.importorskip(name)
+    codec = get_codec(name)
+    assert codec.name == name
+    msg = {"id": 1, "type": "result", "result": {"state": "é"}}
+    assert codec.loads(codec.dumps(msg).encode("utf-8")) == msg
+    assert isinstance(codec.dumps(msg), str)
+
+
+@pytest.mark.asyncio
+async def test_coalescing_needs_supported_version():
+    connector = make_connected()
+    for version in [None, "0.118.5", "2022.2.9", "dev"]:
+        await connector._enable_coalescing(version)
+    assert connector.connection.sent == []
+
+
+@pytest.mark.asyncio
+async def test_coalescing_failure_is_not_an_error(caplog):
+    connector = make_connected()
+    enable = ensure_future(connector._enable_coalescing("2023.1.0b1"))
+    await sleep(0)
+    [command] = connector.connection.sent
+    assert command["type"] == "supported_features"
+    await connector._handle_message(
+        {
+            "id": command["id"],
+            "type": "result",
+            "success": False,
+            "error": {"code": "unknown_command", "message": "Unknown command."},
+        }
+    )
+    await wait_for(enable, 1)
+    assert not [record for record in caplog.records if record.levelname == "ERROR"]
+
+
+@pytest.mark.asyncio
+async def test_handle_frame_array():
+    connector = make_connected()
+    first = ensure_future(connector.send_command({"type": "get_config"}, wait=True))
+    second = ensure_future(connector.send_command({"type": "get_states"}, wait=True))
+    await sleep(0)
+    await connector._handle_frame(
+        [
+            {"id": command["id"], "type": "result", "success": True, "result": i}
+            for i, command in enumerate(connector.connection.sent)
+        ]
+    )
+    assert await wait_for(gather(first, second), 1) == [0, 1]
+
+
+def matched_entities(*skills):
+    """Find the matched entities for a bot with the given skill functions."""
+    connector = make_connector()
+    connector.opsdroid = SimpleNamespace(skills=list(skills))
+    return connector._find_matched_entities()
+
+
+def test_find_matched_entities():
+    def skill(matcher):
+        async def handler():
+            pass
+
+        return matcher(handler)
+
+    assert matched_entities(
+        skill(match_hass_state_changed("light.kitchen")),
+        skill(match_event(HassEvent, entity_id="sun.sun")),
+        skill(match_event("HassEvent", entity_id="switch.fan")),
+        skill(match_catchall(messages_only=True)),
+    ) == {"light.kitchen", "sun.sun", "switch.fan"}
+
+    assert matched_entities(skill(match_always())) is None
+    assert matched_entities(skill(match_catchall())) is None
+    assert matched_entities(skill(match_event(HassEvent))) is None
+    assert matched_entities(skill(match_event(HassPresenceChanged))) is None
+
+
+async def subscribe_filtered(connector, result):
+    """Subscribe to the entities matched by a skill and answer the trigger subscription."""
+
+    async def skill():
+        pass
+
+    connector.opsdroid = SimpleNamespace(
+        skills=[match_hass_state_changed("light.kitchen")(skill)]
+    )
+
+    async def query_api(endpoint, **kwargs):
+        return [
+            {"entity_id": "light.kitchen", "state": "on"},
+            {"entity_id": "sun.sun", "state": "above_horizon"},
+        ]
+
+    connector.query_api = query_api
+    await connector._subscribe_state_changes()
+    await sleep(0)
+    [command] = connector.connection.sent
+    assert command["type"] == "subscribe_trigger"
+    assert command["trigger"]["entity_id"] == ["light.kitchen"]
+    await connector._handle_message(dict(result, id=command["id"], type="result"))
+    await sleep(0.01)
+    return connector.connection.sent[1:]
+
+
+@pytest.mark.asyncio
+async def test_filter_events_subscribes_trigger():
+    connector = make_connected(filter_events=True)
+    sent = await subscribe_filtered(connector, {"success": True})
+    assert sent == []
+    assert connector.watched_entities == {"light.kitchen"}
+
+
+@pytest.mark.asyncio
+async def test_filter_events_falls_back_to_all_state_changes():
+    connector = make_connected(filter_events=True)
+    sent = await subscribe_filtered(
+        connector,
+        {"success": False, "error": {"code": "unknown_command", "message": "Unknown"}},
+    )
+    assert [command["type"] for command in sent] == ["subscribe_events"]
+    assert connector.watched_entities is None
+    assert connector.state_cache.complete
+    assert connector.state_cache.get("sun.sun").state == "above_horizon"
+
+
+@pytest.mark.asyncio
+async def test_presence_changed_events():
+    connector = make_connector()
+    events = record_events(connector)
+
+    async def query_api(endpoint, **kwargs):
+        return [
+            {"entity_id": "device_tracker.a", "state": "home"},
+            {"entity_id": "device_tracker.b", "state": "not_home"},
+        ]
+
+    connector.query_api = query_api
+    await connector._sync_states()
+
+    def presence_events():
+        return [event for event in events if isinstance(event, HassPresenceChanged)]
+
+    assert presence_events() == []
+
+    # Moving between zones which aren't home doesn't change who is home.
+    await connector._handle_state_changed(
+        state_changed("device_tracker.b", "not_home", "work")
+    )
+    assert presence_events() == []
+
+    await connector._handle_state_changed(
+        state_changed("device_tracker.a", "home", "not_home")
+    )
+    [event] = presence_events()
+    assert not event.get_entity("anyone_home")
+    assert event.get_entity("not_home") == 1
+
+    await connector._handle_state_changed(
+        state_changed("device_tracker.b", "work", "home")
+    )
+    assert len(presence_events()) == 2
+    assert presence_events()[-1].get_entity("anyone_home")
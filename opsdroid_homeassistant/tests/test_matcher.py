@@ -14,3 +14,18 @@ async def test_match_hass_state_changed(mock_skill):
 
     assert await mock_skill.get_state(test_entity) == "off"
     assert mock_skill.kitchen_lights_changed
+
+
+@pytest.mark.asyncio
+async def test_match_hass_state_changed_attributes(mock_skill):
+    test_entity = "light.living_room_rgbww_lights"
+
+    await mock_skill.turn_on(test_entity, brightness=50, _wait=True)
+    await sleep(0.1)
+    mock_skill.living_room_brightness_changed = False
+
+    await mock_skill.turn_on(test_entity, brightness=100, _wait=True)
+    await sleep(0.1)
+
+    assert await mock_skill.get_state(test_entity) == "on"
+    assert mock_skill.living_room_brightness_changed
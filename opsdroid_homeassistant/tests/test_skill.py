@@ -94,3 +94,80 @@ async def test_set_value(mock_skill, caplog):
 
     await mock_skill.set_value("light.bed_light", "Foo")
     assert "unsupported entity light.bed_light" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_cached_state(connector, mock_skill):
+    entity = "light.ceiling_lights"
+    assert connector.state_cache.synced
+    assert await mock_skill.get_state(entity) == await mock_skill.get_state(
+        entity, fresh=True
+    )
+
+    await mock_skill.toggle(entity)
+    await sleep(0.1)
+    assert await mock_skill.get_state(entity) == await mock_skill.get_state(
+        entity, fresh=True
+    )
+
+
+@pytest.mark.asyncio
+async def test_call_service_wait(mock_skill):
+    from opsdroid_homeassistant import HassCommandError
+
+    await mock_skill.turn_on("light.bed_light", _wait=True)
+    assert await mock_skill.get_state("light.bed_light", fresh=True) == "on"
+    await mock_skill.turn_off("light.bed_light", _wait=True)
+
+    with pytest.raises(HassCommandError):
+        await mock_skill.call_service("not_a_domain", "not_a_service", _wait=True)
+
+
+@pytest.mark.asyncio
+async def test_get_entities(mock_skill):
+    lights = await mock_skill.get_entities("light")
+    assert lights
+    assert all(light["entity_id"].startswith("light.") for light in lights)
+    assert sorted(light["entity_id"] for light in lights) == sorted(
+        light["entity_id"] for light in await mock_skill.get_entities("light", True)
+    )
+    assert await mock_skill.get_entities("not_a_domain") == []
+
+
+@pytest.mark.asyncio
+async def test_presence_counts(connector, mock_skill):
+    trackers = await mock_skill.get_trackers(fresh=True)
+    presence = await connector.get_presence()
+    assert presence == await connector.get_presence(fresh=True)
+    assert sum(presence.values()) == len(trackers)
+    assert await mock_skill.anyone_home() == any(
+        tracker["state"] == "home" for tracker in trackers
+    )
+
+
+@pytest.mark.asyncio
+async def test_call_service_timeout_is_service_data():
+    from opsdroid_homeassistant import HassSkill
+
+    class Hass:
+        async def send(self, event):
+            self.event = event
+
+    skill = HassSkill.__new__(HassSkill)
+    skill._hass = Hass()
+    await skill.call_service("remote", "learn_command", timeout=30, _timeout=5)
+    assert skill.hass.event.data == {"timeout": 30}
+    assert skill.hass.event.timeout == 5
+    assert not skill.hass.event.wait
+
+
+@pytest.mark.asyncio
+async def test_read_after_write(connector, mock_skill):
+    entity = "light.ceiling_lights"
+    state = await mock_skill.get_state(entity)
+    await mock_skill.toggle(entity)
+    assert await mock_skill.get_state(entity) != state
+
+    await sleep(0.1)
+    assert not connector.state_cache.is_stale(entity)
+    assert await mock_skill.get_state(entity) != state
@@ -30,6 +30,7 @@ setup(
     ],
     description="Home Assistant support for opsdroid",
     install_requires=REQUIRES,
+    extras_require={"orjson": ["orjson"], "ujson": ["ujson"]},
     license="Apache Software License 2.0",
     long_description=README,
     long_description_content_type="text/markdown",